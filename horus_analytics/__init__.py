@@ -5,30 +5,364 @@ from horus_geopandas import HorusGeoDataFrame
 import pandas as pd
 import geopandas as gpd
 import fiona
+import numpy as np
+import shapely
 
-from math import radians, cos, sin, asin, sqrt
+from enum import Enum
+from pyproj import Geod
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from scipy.spatial import KDTree
 
+# Mean earth radius (IUGG) in meters
+EARTH_RADIUS = 6371008.8
 
-def haversine(point1, point2):  # lon1, lat1, lon2, lat2):
+WGS84 = Geod(ellps="WGS84")
+
+
+class Metric(Enum):
+    """Distance metric between geographic locations
+
+    HAVERSINE:  great circle distance on a sphere with the mean earth radius
+    GEODESIC:   geodesic distance on the WGS84 ellipsoid
     """
-    Calculate the great circle distance between two points
-    on the earth (specified in decimal degrees)
+
+    HAVERSINE = "haversine"
+    GEODESIC = "geodesic"
+
+
+def distance(lon1, lat1, lon2, lat2, metric=Metric.HAVERSINE):
     """
+    Calculate the distances in meters between (arrays of) points
+    specified in decimal degrees, element-wise.
 
-    lon1 = point1.x
-    lat1 = point1.y
-    lon2 = point2.x
-    lat2 = point2.y
+    The arguments are scalars or arrays that broadcast against each other.
+    """
+    lon1, lat1, lon2, lat2 = np.broadcast_arrays(
+        *(np.asarray(v, dtype=float) for v in (lon1, lat1, lon2, lat2))
+    )
+    if metric == Metric.GEODESIC:
+        if lon1.ndim == 0:
+            return WGS84.inv(lon1.item(), lat1.item(), lon2.item(), lat2.item())[2]
+        _, _, m = WGS84.inv(lon1.ravel(), lat1.ravel(), lon2.ravel(), lat2.ravel())
+        return np.reshape(m, lon1.shape)
 
-    # convert decimal degrees to radians
-    lon1, lat1, lon2, lat2 = map(radians, [lon1, lat1, lon2, lat2])
+    lon1, lat1, lon2, lat2 = map(np.radians, [lon1, lat1, lon2, lat2])
     # haversine formula
     dlon = lon2 - lon1
     dlat = lat2 - lat1
-    a = sin(dlat / 2) ** 2 + cos(lat1) * cos(lat2) * sin(dlon / 2) ** 2
-    c = 2 * asin(sqrt(a))
-    m = 6367000 * c
-    return m
+    a = np.sin(dlat / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin(dlon / 2) ** 2
+    c = 2 * np.arcsin(np.sqrt(a))
+    return EARTH_RADIUS * c
+
+
+def pairwise_distance(lon1, lat1, lon2, lat2, metric=Metric.HAVERSINE):
+    """
+    Calculate the distance matrix in meters between n points (lon1, lat1)
+    and m points (lon2, lat2) specified in decimal degrees.
+
+    Returns an array of shape (n, m).
+    """
+    return distance(
+        np.asarray(lon1, dtype=float)[:, np.newaxis],
+        np.asarray(lat1, dtype=float)[:, np.newaxis],
+        np.asarray(lon2, dtype=float)[np.newaxis, :],
+        np.asarray(lat2, dtype=float)[np.newaxis, :],
+        metric,
+    )
+
+
+def geometry_distance(geoms1, geoms2, metric=Metric.HAVERSINE):
+    """
+    Calculate the distances in meters between (arrays of) point geometries
+    in decimal degrees, element-wise.
+    """
+    return distance(
+        shapely.get_x(geoms1),
+        shapely.get_y(geoms1),
+        shapely.get_x(geoms2),
+        shapely.get_y(geoms2),
+        metric,
+    )
+
+
+def haversine(point1, point2):
+    """
+    Calculate the great circle distance between two points
+    on the earth (specified in decimal degrees)
+    """
+    return float(distance(point1.x, point1.y, point2.x, point2.y))
+
+
+def sphere_coordinates(lon, lat):
+    """
+    Cartesian coordinates in meters, shape (n, 3), of points specified in
+    decimal degrees on a sphere with the mean earth radius.
+
+    The straight line (chord) distance between these coordinates is
+    monotonic in the haversine distance, which makes them suitable for a
+    spatial index anywhere on earth.
+    """
+    lon, lat = np.radians(lon), np.radians(lat)
+    cos_lat = np.cos(lat)
+    return EARTH_RADIUS * np.column_stack(
+        (cos_lat * np.cos(lon), cos_lat * np.sin(lon), np.sin(lat))
+    )
+
+
+def neighbour_pairs(lon, lat, radius, classes=None):
+    """
+    Find all pairs of points within radius meters (haversine) of each other.
+
+    lon, lat: point coordinates in decimal degrees
+    classes:  optional class per point, only points of the same class pair up
+
+    Returns an array of shape (k, 2) of point indices i < j.
+    """
+    tree = KDTree(sphere_coordinates(lon, lat))
+    chord = 2 * EARTH_RADIUS * np.sin(radius / (2 * EARTH_RADIUS))
+    pairs = tree.query_pairs(chord, output_type="ndarray")
+    if classes is not None and len(pairs) > 0:
+        classes = np.asarray(classes)
+        pairs = pairs[classes[pairs[:, 0]] == classes[pairs[:, 1]]]
+    return pairs.reshape(-1, 2)
+
+
+def cluster_pairs(size, pairs):
+    """
+    Merge size elements into clusters, elements of a pair share a cluster.
+
+    Returns the cluster ids (starting at 1, numbered in order of the first
+    element of every cluster) and the cluster confidences. The confidence of
+    an element is the fraction of its cluster it is directly paired with
+    (including itself), 1.0 for fully connected clusters.
+    """
+    pairs = np.asarray(pairs, dtype=np.intp).reshape(-1, 2)
+    graph = coo_matrix(
+        (np.ones(len(pairs), dtype=np.int8), (pairs[:, 0], pairs[:, 1])),
+        shape=(size, size),
+    )
+    _, labels = connected_components(graph, directed=False)
+
+    # renumber the labels by their first element
+    _, first, inverse = np.unique(labels, return_index=True, return_inverse=True)
+    rank = np.empty(len(first), dtype=np.intp)
+    rank[np.argsort(first)] = np.arange(1, len(first) + 1)
+    clstr_id = rank[inverse]
+
+    degree = np.bincount(pairs.ravel(), minlength=size)
+    clstr_size = np.bincount(clstr_id)[clstr_id]
+    clstr_conf = (degree + 1) / clstr_size
+    return clstr_id, clstr_conf
+
+
+def cluster_points(lon, lat, radius, classes=None):
+    """
+    Cluster points (single linkage) within radius meters of each other.
+
+    lon, lat: point coordinates in decimal degrees
+    classes:  optional class per point, clusters never mix classes
+
+    Returns the arrays (clstr_id, clstr_conf), see cluster_pairs.
+    """
+    pairs = neighbour_pairs(lon, lat, radius, classes)
+    return cluster_pairs(len(np.atleast_1d(lon)), pairs)
+
+
+def frame_window_pairs(rec_id, frame_idx, frame_window):
+    """
+    Find all pairs of measurements of the same recording whose frames are
+    at most frame_window frames apart. Measurements of the same frame
+    never pair up, one frame does not show the same object twice.
+
+    Returns an array of shape (k, 2) of measurement indices.
+    """
+    rec_id = np.asarray(rec_id)
+    frame_idx = np.asarray(frame_idx, dtype=np.int64)
+    if len(frame_idx) == 0:
+        return np.empty((0, 2), dtype=np.intp)
+
+    order = np.lexsort((frame_idx, rec_id))
+    _, rec_rank = np.unique(rec_id[order], return_inverse=True)
+    frames = frame_idx[order]
+
+    # lay out the recordings one after the other, at least a window apart
+    frames = frames - frames.min()
+    frames = frames + rec_rank * (frames.max() + frame_window + 1)
+
+    start = np.searchsorted(frames, frames, side="right")
+    end = np.searchsorted(frames, frames + frame_window, side="right")
+    counts = end - start
+
+    first = np.repeat(np.arange(len(frames)), counts)
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    second = np.repeat(start, counts) + offsets
+    return np.column_stack((order[first], order[second]))
+
+
+def plausible_ray_pairs(pairs, cam_lon, cam_lat, yaw, lon, lat, tolerance):
+    """
+    Select the pairs of measurements that can show the same object.
+
+    Every measurement is a viewing ray from its camera (cam_lon, cam_lat) in
+    the direction yaw (degrees, true north) and a location (lon, lat) of the
+    object. A pair is plausible when each location lies in front of the
+    other camera, within tolerance meters from its viewing ray.
+
+    Returns a boolean mask over the pairs.
+    """
+    pairs = np.asarray(pairs, dtype=np.intp).reshape(-1, 2)
+    cam_lon, cam_lat, yaw, lon, lat = (
+        np.asarray(v, dtype=float) for v in (cam_lon, cam_lat, yaw, lon, lat)
+    )
+    mask = np.ones(len(pairs), dtype=bool)
+    for cam, loc in ((pairs[:, 0], pairs[:, 1]), (pairs[:, 1], pairs[:, 0])):
+        # local east/north offset in meters from the camera to the location
+        mid_lat = np.radians((cam_lat[cam] + lat[loc]) / 2)
+        east = EARTH_RADIUS * np.cos(mid_lat) * np.radians(lon[loc] - cam_lon[cam])
+        north = EARTH_RADIUS * np.radians(lat[loc] - cam_lat[cam])
+
+        ray_yaw = np.radians(yaw[cam])
+        along = east * np.sin(ray_yaw) + north * np.cos(ray_yaw)
+        across = east * np.cos(ray_yaw) - north * np.sin(ray_yaw)
+        mask &= (along > 0) & (np.abs(across) <= tolerance)
+    return mask
+
+
+def cluster_measurements(
+    dataframe,
+    radius=3.0,
+    class_field="dt_class",
+    frame_window=None,
+    ray_tolerance=None,
+):
+    """
+    Cluster the single measurements of a dataframe by their geometry.
+
+    Without frame_window, all measurements (of the same class) within
+    radius meters of each other are clustered.
+
+    With frame_window, only measurements of the same recording (rec_id)
+    at most frame_window frames (frame_idx) apart are compared. These pairs
+    must also have plausible viewing rays (cam_lon, cam_lat, dt_yaw) within
+    ray_tolerance meters (default: radius), see plausible_ray_pairs.
+    This keeps nearby distinct objects apart and compares far fewer pairs.
+
+    Returns the arrays (clstr_id, clstr_conf), see cluster_pairs.
+    """
+    geoms = dataframe.geometry.to_numpy()
+    lon, lat = shapely.get_x(geoms), shapely.get_y(geoms)
+    classes = dataframe[class_field].to_numpy() if class_field else None
+    if frame_window is None:
+        return cluster_points(lon, lat, radius, classes)
+
+    pairs = frame_window_pairs(
+        dataframe["rec_id"].to_numpy(), dataframe["frame_idx"].to_numpy(), frame_window
+    )
+    if classes is not None:
+        pairs = pairs[classes[pairs[:, 0]] == classes[pairs[:, 1]]]
+    pairs = pairs[
+        plausible_ray_pairs(
+            pairs,
+            dataframe["cam_lon"].to_numpy(),
+            dataframe["cam_lat"].to_numpy(),
+            dataframe["dt_yaw"].to_numpy(),
+            lon,
+            lat,
+            radius if ray_tolerance is None else ray_tolerance,
+        )
+    ]
+    i, j = pairs[:, 0], pairs[:, 1]
+    pairs = pairs[distance(lon[i], lat[i], lon[j], lat[j]) <= radius]
+    return cluster_pairs(len(dataframe), pairs)
+
+
+def cluster_rays(
+    lat,
+    lon,
+    alt,
+    yaw,
+    pitch,
+    max_distance=1.0,
+    max_range=50.0,
+    min_range=1.0,
+    classes=None,
+):
+    """
+    Cluster viewing rays that pass within max_distance meters of each other,
+    and triangulate every cluster in the same pass.
+
+    lat, lon, alt, yaw, pitch: position vector components per ray, see
+                               horus_gis.PositionVector
+    max_range:                 length in meters of every ray
+    min_range:                 minimum distance of the closest approach from
+                               both cameras, rays of the same camera meet
+                               at the camera itself
+    classes:                   optional class per ray, clusters never mix classes
+
+    The rays are segments of max_range meters, candidate pairs are found in
+    a KDTree of the segment midpoints.
+
+    Returns the arrays (clstr_id, clstr_conf, locations), locations has shape
+    (number of clusters, 3) and holds the triangulated (lat, lon, alt) of
+    cluster id i at row i - 1, NaN for clusters of a single ray.
+    """
+    origins, directions = hg.Geographic.rays(lat, lon, alt, yaw, pitch)
+
+    tree = KDTree(origins + directions * (max_range / 2))
+    pairs = tree.query_pairs(max_range + max_distance, output_type="ndarray")
+    pairs = pairs.reshape(-1, 2)
+    if classes is not None:
+        classes = np.asarray(classes)
+        pairs = pairs[classes[pairs[:, 0]] == classes[pairs[:, 1]]]
+
+    i, j = pairs[:, 0], pairs[:, 1]
+    gap, t1, t2 = hg.Geographic.closest_approach(
+        origins[i], directions[i], origins[j], directions[j]
+    )
+    pairs = pairs[
+        (gap <= max_distance)
+        & (t1 >= min_range)
+        & (t1 <= max_range)
+        & (t2 >= min_range)
+        & (t2 <= max_range)
+    ]
+
+    clstr_id, clstr_conf = cluster_pairs(len(origins), pairs)
+    locations = hg.Geographic.triangulate_rays(origins, directions, clstr_id - 1)
+    return clstr_id, clstr_conf, locations
+
+
+def cluster_position_vectors(pos_vectors, **kwargs):
+    """
+    Cluster and triangulate a sequence of horus_gis.PositionVector,
+    see cluster_rays.
+    """
+    components = np.asarray(pos_vectors, dtype=float).reshape(-1, 5).T
+    return cluster_rays(*components, **kwargs)
+
+
+def cluster_measurement_rays(
+    dataframe,
+    yaw_field="dt_yaw",
+    pitch_field="dt_pitch",
+    class_field="dt_class",
+    **kwargs,
+):
+    """
+    Cluster and triangulate the viewing rays of the single measurements of a
+    dataframe (cam_lat, cam_lon, cam_alt and the yaw and pitch fields),
+    see cluster_rays.
+    """
+    return cluster_rays(
+        dataframe["cam_lat"].to_numpy(),
+        dataframe["cam_lon"].to_numpy(),
+        dataframe["cam_alt"].to_numpy(),
+        dataframe[yaw_field].to_numpy(),
+        dataframe[pitch_field].to_numpy(),
+        classes=dataframe[class_field].to_numpy() if class_field else None,
+        **kwargs,
+    )
 
 
 class Clustering_analysis:
@@ -37,10 +371,12 @@ class Clustering_analysis:
     schema_provider: SchemaProvider
 
     layers: None
+    metric: Metric
 
     def __init__(self):
         self.schema_provider = SchemaProvider()
         self.layers = {}
+        self.metric = Metric.HAVERSINE
 
     def cluster_data_layer(self, filename, layer=None):
         schema = self.schema_provider.merge(
@@ -82,24 +418,44 @@ class Clustering_analysis:
 
         loc_df = self.cluster_location_layer.dataframe
         data_df = self.cluster_layer.dataframe
-        for index, row in loc_df.iterrows():
-            mask = data_df["clstr_id"] == row["clstr_id"]
-            entries = data_df.loc[mask]
-            for point_i, point_r in entries.iterrows():
-                record = database.new_frame()
-                record["geometry"] = point_r["geometry"]
-                record["usr_id"] = point_r["usr_id"]
-                record["distance"] = haversine(row["geometry"], point_r["geometry"])
-                record["angle"] = point_r["dt_yaw"] - point_r["azimuth"]
-
-                database.add_frame(record)
+
+        # every entry joined with its cluster location, in cluster location order
+        entries = pd.merge(
+            pd.DataFrame(
+                {
+                    "clstr_id": loc_df["clstr_id"].to_numpy(),
+                    "clstr_geom": loc_df.geometry.to_numpy(),
+                }
+            ),
+            pd.DataFrame(data_df),
+            on="clstr_id",
+        )
+
+        cluster_geoms = entries["clstr_geom"].to_numpy()
+        entry_geoms = entries["geometry"].to_numpy()
+        entry_distance = geometry_distance(cluster_geoms, entry_geoms, self.metric)
+
+        database.add_records(
+            {
+                "geometry": entry_geoms,
+                "usr_id": entries["usr_id"].to_numpy(),
+                "distance": entry_distance.astype(int),
+                "angle": (entries["dt_yaw"] - entries["azimuth"]).to_numpy(),
+            }
+        )
 
         self.layers["cluster_entries_analysis"] = database
 
     def analyse_cluster(self):
         """
-        Adds the cluster_analysis layer with:
-        distance: meter to triangulation
+        Adds the cluster_analysis layer with per cluster statistics:
+        geometry: centroid of the cluster entries, the cluster location without entries
+        clstr_pts: number of entries (0 for a cluster location without entries)
+        clstr_rms: root mean square distance (meter) of the entries to the centroid
+        mean_conf: mean detection confidence
+        frm_span: number of frames between the first and the last entry of a
+                  recording, the largest span when the cluster has entries of
+                  several recordings
         """
         schema = SchemaProvider.Schema("Analysis clusters")
         schema.fields = [
@@ -108,24 +464,93 @@ class Clustering_analysis:
                 "Cluster geometry.",
                 SchemaProvider.Geometry(SchemaProvider.Geometry.Type.POINT_3D),
             ),
+            SchemaProvider.Field("clstr_id", "The cluster id of the cluster.", int),
             SchemaProvider.Field(
                 "clstr_pts", "Number of points used for clustering.", int
             ),
+            SchemaProvider.Field(
+                "clstr_rms", "RMS distance of the points to the centroid.", float
+            ),
+            SchemaProvider.Field(
+                "mean_conf", "Mean detection confidence of the points.", float
+            ),
+            SchemaProvider.Field(
+                "frm_span",
+                "Largest frame index span of the points within a recording.",
+                int,
+            ),
         ]
         database = HorusGeoDataFrame(schema)
 
         loc_df = self.cluster_location_layer.dataframe
         data_df = self.cluster_layer.dataframe
-        for index, row in loc_df.iterrows():
-            mask = data_df["clstr_id"] == row["clstr_id"]
-            entries = data_df.loc[mask]
-
-            record = database.new_frame()
-            geoms = []
-            for point_i, point_r in entries.iterrows():
-                geoms.append(point_r["geometry"])
-            record["clstr_pts"] = len(geoms)
-            database.add_frame(record)
+
+        geoms = data_df.geometry.to_numpy()
+        data = pd.DataFrame(
+            {
+                "clstr_id": data_df["clstr_id"].to_numpy(),
+                "x": shapely.get_x(geoms),
+                "y": shapely.get_y(geoms),
+                "z": np.where(shapely.has_z(geoms), shapely.get_z(geoms), 0.0),
+                "conf": data_df["dt_conf"].to_numpy(dtype=float),
+                "rec": data_df["rec_id"].to_numpy(),
+                "frame": data_df["frame_idx"].to_numpy(),
+            }
+        )
+        data = data[data["clstr_id"].isin(loc_df["clstr_id"])]
+        grouped = data.groupby("clstr_id", sort=False)
+
+        # squared distance of every entry to the centroid of its cluster
+        data = data.assign(
+            sq_dist=distance(
+                grouped["x"].transform("mean"),
+                grouped["y"].transform("mean"),
+                data["x"],
+                data["y"],
+                self.metric,
+            )
+            ** 2
+        )
+
+        stats = data.groupby("clstr_id", sort=False).agg(
+            clstr_pts=("x", "size"),
+            x=("x", "mean"),
+            y=("y", "mean"),
+            z=("z", "mean"),
+            sq_dist=("sq_dist", "mean"),
+            mean_conf=("conf", "mean"),
+        )
+        # frame indices only compare within a recording
+        frames = data.groupby(["clstr_id", "rec"], sort=False)["frame"]
+        span = frames.max() - frames.min()
+        stats["frm_span"] = span.groupby(level="clstr_id").max()
+
+        # one row per cluster location, in cluster location order, a location
+        # without entries has 0 points at the location itself
+        locations = loc_df.drop_duplicates("clstr_id").set_index("clstr_id")
+        stats = stats.reindex(locations.index)
+        empty = stats["clstr_pts"].isna().to_numpy()
+        stats = stats.fillna(
+            {
+                "clstr_pts": 0,
+                "sq_dist": 0.0,
+                "mean_conf": 0.0,
+                "frm_span": 0,
+            }
+        )
+        geometry = shapely.points(stats["x"], stats["y"], stats["z"])
+        geometry[empty] = shapely.force_3d(locations.geometry.to_numpy()[empty])
+
+        database.add_records(
+            {
+                "geometry": geometry,
+                "clstr_id": stats.index.to_numpy(),
+                "clstr_pts": stats["clstr_pts"],
+                "clstr_rms": np.sqrt(stats["sq_dist"]),
+                "mean_conf": stats["mean_conf"],
+                "frm_span": stats["frm_span"],
+            }
+        )
 
         self.layers["cluster_analysis"] = database
 
@@ -1,5 +1,6 @@
 from PIL import Image, ImageDraw
 from io import BytesIO
+import numpy
 import math
 import io
 
@@ -520,6 +521,16 @@ class SphericalCamera(Camera):
         geo_locations: [GeographicLocation],
         draw_geometry: bool = False,
     ) -> SphericalImage:
+        """Crop the image to the (bounding box of the) geometry
+
+        Without drawing, the region is requested from the media-server instead:
+        a view centered on the geometry at the pixel density of the image.
+        This avoids decoding and re-encoding (a generation loss) the image,
+        and the image request keeps matching the pixels, so pixel
+        computations remain valid. The image can therefore be acquired
+        with manual_fetch. Falls back to cropping the image when the region
+        is outside the field of view range of the camera.
+        """
         if not horus_geometries_found:
             raise Exception("Function not supported, requires horus_geometries.")
 
@@ -532,6 +543,16 @@ class SphericalCamera(Camera):
         else:
             camera_model = CameraModel(self.frame.get_location(), self.frame.heading)
 
+        if not draw_geometry:
+            request = self.region_request(image, camera_model, geo_locations)
+            if request is not None:
+                image.image_request = request
+                image.fetch()
+                return image
+
+        if image.result is None:
+            image.fetch()
+
         size = image.image_request.size
         computation_request_builder = ComputationRequestBuilder("project")
 
@@ -570,6 +591,66 @@ class SphericalCamera(Camera):
 
         return image
 
+    def region_request(
+        self,
+        image: SphericalImage,
+        camera_model: CameraModel,
+        geo_locations: [GeographicLocation],
+    ) -> ImageRequest:
+        """Returns the request of the smallest view centered on the geometry,
+        at the pixel density of the image.
+
+        Returns None when the view is out of the field of view range.
+        """
+        directions = numpy.array(
+            [camera_model.to_enu([p.lon, p.lat, p.alt]) for p in geo_locations]
+        )
+        directions /= numpy.linalg.norm(directions, axis=1)[:, None]
+
+        def gnomonic(center):
+            # tangent plane coordinates (right, up) of the directions, None when
+            # looking straight up/down (no horizon) or at a direction behind
+            center = center / numpy.linalg.norm(center)
+            right = numpy.cross(center, [0, 0, 1])
+            norm = numpy.linalg.norm(right)
+            depth = directions @ center
+            if norm < 1e-6 or (depth <= 0).any():
+                return None
+            right /= norm
+            up = numpy.cross(right, center)
+            plane = directions @ numpy.c_[right, up] / depth[:, None]
+            return center, right, up, plane
+
+        # center the view on the bounding box of the geometry
+        view = gnomonic(directions.mean(axis=0))
+        if view is None:
+            return None
+        center, right, up, plane = view
+        x, y = (plane.min(axis=0) + plane.max(axis=0)) / 2
+        view = gnomonic(center + x * right + y * up)
+        if view is None:
+            return None
+        center, right, up, plane = view
+
+        size = image.get_resolution()
+        focal = size.width / 2 / math.tan(math.radians(image.get_field_of_view()) / 2)
+        width, height = numpy.ceil(2 * focal * abs(plane).max(axis=0)).astype(int)
+        h_fov = 2 * math.degrees(math.atan(width / 2 / focal))
+        v_fov = 2 * math.degrees(math.atan(height / 2 / focal))
+        if not (
+            self.h_fov.min <= h_fov <= self.h_fov.max
+            and self.v_fov.min < v_fov < self.v_fov.max
+        ):
+            return None
+
+        yaw, pitch = camera_model.get_direction(center)
+        request_builder = ImageRequestBuilder(self.frame.recordingid, self.frame.uuid)
+        return request_builder.build_spherical(
+            Size(int(width), int(height)),
+            Direction(yaw - self.frame.heading, pitch),
+            h_fov,
+        )
+
     def acquire(self, size: Size, manual_fetch: bool = False) -> SphericalImage:
         """Acquire a Spherical image from the current position/configuration of the camera"""
 
@@ -4,6 +4,9 @@ Utilities and Classes build on top of GeoPandas
 """
 
 
+import json
+import itertools
+from enum import Enum
 from horus_gis import SchemaProvider
 import horus_gis as hg
 
@@ -13,23 +16,77 @@ try:
     import fiona as fi
     from fiona.crs import from_epsg
     import geopandas as gpd
+    import shapely
+    from pyproj import CRS
 except ModuleNotFoundError as e:
     print(f"Install module '{e.name}' to use this module.")
     raise e
 
+# Optional, GeoParquet support
+pyarrow_found = False
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+
+    pyarrow_found = True
+except ModuleNotFoundError:
+    pass
+
+
+class Validation(Enum):
+    """When HorusGeoDataFrame validates its data against the schema
+
+    EAGER:      every frame, file and record when it is added
+    PER_BATCH:  every frame and file when it is added, records per batch
+    ON_WRITE:   the entire dataframe once, before it is written (or validate())
+    SAMPLED:    a random sample of every frame, file and batch when it is added,
+                the data is not coerced
+    """
+
+    EAGER = "eager"
+    PER_BATCH = "per_batch"
+    ON_WRITE = "on_write"
+    SAMPLED = "sampled"
+
+    def __str__(self):
+        return self.value
+
 
 class HorusGeoDataFrame:
+    """GeoDataFrame with a SchemaProvider schema
+
+    Records can be added one at a time as a GeoDataFrame (add_frame), or
+    buffered (add_record, add_records) and validated and added per batch.
+    When the data is validated depends on the Validation policy; the index
+    of the added data is renumbered, so validation errors refer to the
+    rows of the entire dataframe.
+    """
+
     schema: SchemaProvider.Schema
-    dataframe: gpd.GeoDataFrame
     non_geom_schema: pa.DataFrameSchema
     fiona_schema: dict
     crs: str
 
     fields: None
+    geometry_field: str
+    batch_size: int
+    validation: Validation
+    sample_size: int
 
-    def __init__(self, schema: SchemaProvider.Schema):
+    def __init__(
+        self,
+        schema: SchemaProvider.Schema,
+        batch_size=10000,
+        validation=Validation.PER_BATCH,
+        sample_size=100,
+    ):
         self.crs = "EPSG:4326"
         self.schema = schema
+        self.batch_size = batch_size
+        self.validation = Validation(validation)
+        self.sample_size = sample_size
+        self.geometry_field = None
 
         # Convert schema's
         # https://pandera.readthedocs.io/en/latest/dataframe_schemas.html
@@ -44,6 +101,8 @@ class HorusGeoDataFrame:
             if is_geom:
                 pan_schema[field.name] = pa.Column(pa.engines.pandas_engine.Geometry)
                 self.fiona_schema[field.name] = str(field.type)
+                if self.geometry_field is None:
+                    self.geometry_field = field.name
             else:
                 pan_schema[field.name] = pa.Column(field.type)
                 self.fiona_schema["properties"][field.name] = list(
@@ -59,8 +118,45 @@ class HorusGeoDataFrame:
             coerce=True,
         )
 
-        self.dataframe = gpd.GeoDataFrame(columns=self.fields)
-        self.at = self.dataframe.at
+        self.__dataframe = gpd.GeoDataFrame(columns=self.fields)
+        # validated batches, not yet concatenated with the dataframe
+        self.__batches = []
+        self.__batches_size = 0
+        # buffered records, not yet validated
+        self.__records = {name: [] for name in self.fields}
+        self.__records_size = 0
+
+    @property
+    def dataframe(self) -> gpd.GeoDataFrame:
+        """The GeoDataFrame, including the buffered records"""
+        self.flush()
+        if len(self.__batches) > 0:
+            if len(self.__dataframe) > 0:
+                self.__dataframe = pd.concat([self.__dataframe, *self.__batches])
+            else:
+                # the initial frame has no rows, only the column order is kept
+                dataframe = pd.concat(self.__batches)
+                columns = [x for x in self.__dataframe.columns if x in dataframe]
+                columns += [x for x in dataframe.columns if x not in columns]
+                self.__dataframe = dataframe[columns]
+            self.__batches = []
+            self.__batches_size = 0
+        return self.__dataframe
+
+    @dataframe.setter
+    def dataframe(self, dataframe: gpd.GeoDataFrame):
+        self.flush()
+        self.__batches = []
+        self.__batches_size = 0
+        self.__dataframe = dataframe
+
+    @property
+    def at(self):
+        return self.dataframe.at
+
+    def __len__(self):
+        """Number of records, including the buffered records"""
+        return len(self.__dataframe) + self.__batches_size + self.__records_size
 
     def new_frame(self, geom=None):
         if geom is None:
@@ -68,21 +164,280 @@ class HorusGeoDataFrame:
         return gpd.GeoDataFrame(columns=self.fields, geometry=geom, crs=self.crs)
 
     def add_frame(self, dataframe, validate=True):
+        self.flush()
+        dataframe = self.__renumber(dataframe)
         if validate:
-            self.non_geom_schema.validate(dataframe)
-        self.dataframe = pd.concat([self.dataframe, dataframe])
+            dataframe = self.__validate_added(dataframe)
+        self.__batches.append(dataframe)
+        self.__batches_size += len(dataframe)
+
+    def add_record(self, record: dict = None, **values):
+        """Buffer a record, a dict (or keywords) mapping field names to values
+
+        Missing fields are None, the geometry is a shapely geometry,
+        unknown fields raise an exception.
+        The buffered records are validated and added once 'batch_size'
+        records are buffered, or when the dataframe is used.
+        """
+        if record is None:
+            record = values
+        self.__check_fields(record)
+        for name, column in self.__records.items():
+            column.append(record.get(name))
+        self.__records_size += 1
+        if (
+            self.__records_size >= self.batch_size
+            or self.validation == Validation.EAGER
+        ):
+            self.flush()
+
+    def add_records(self, records, validate=True):
+        """Add a batch of records
+
+        records: a dict of columns (lists, arrays or series per field name)
+                 or an iterable of record dicts.
+        The batch is validated once.
+        """
+        if not isinstance(records, dict):
+            for record in records:
+                self.add_record(record)
+            return
+
+        if len(records) == 0:
+            return
+        self.__check_fields(records)
+        self.flush()
+        size = max(len(column) for column in records.values())
+        self.__add_batch(records, size, validate)
+
+    def __check_fields(self, names):
+        unknown = [name for name in names if name not in self.__records]
+        if len(unknown) > 0:
+            raise Exception(f"HorusGeoDataFrame unknown field(s) {unknown}.")
+
+    def flush(self, validate=True):
+        """Validate and add the buffered records as one batch"""
+        if self.__records_size == 0:
+            return
+        records, size = self.__records, self.__records_size
+        self.__records = {name: [] for name in self.fields}
+        self.__records_size = 0
+        self.__add_batch(records, size, validate)
+
+    def __add_batch(self, columns, size, validate):
+        start = len(self.__dataframe) + self.__batches_size
+        data = {}
+        for name in self.fields:
+            column = columns.get(name)
+            if column is None:
+                column = [None] * size
+            elif isinstance(column, pd.Series):
+                column = column.to_numpy()
+            data[name] = column
+
+        dataframe = gpd.GeoDataFrame(
+            data,
+            geometry=self.geometry_field,
+            crs=self.crs if self.geometry_field else None,
+            index=pd.RangeIndex(start, start + size),
+        )
+        if validate:
+            dataframe = self.__validate_added(dataframe)
+
+        self.__batches.append(dataframe)
+        self.__batches_size += size
+
+    def __renumber(self, dataframe):
+        start = len(self)
+        return dataframe.set_axis(pd.RangeIndex(start, start + len(dataframe)))
+
+    def __validate_added(self, dataframe):
+        """Validate data that is added according to the validation policy,
+        returns the (coerced) data.
+        """
+        if self.validation == Validation.ON_WRITE or len(dataframe) == 0:
+            return dataframe
+        if self.validation == Validation.SAMPLED:
+            sample = dataframe.sample(
+                n=min(self.sample_size, len(dataframe)), random_state=len(self)
+            )
+            self.non_geom_schema.validate(sample)
+            return dataframe
+        return self.non_geom_schema.validate(dataframe)
+
+    def validate(self):
+        """Validate and coerce the entire dataframe
+
+        All failures are collected, pandera.errors.SchemaErrors.failure_cases
+        holds the offending row indices.
+        """
+        self.dataframe = self.non_geom_schema.validate(self.dataframe, lazy=True)
+        return self.dataframe
+
+    def before_write(self):
+        if self.validation == Validation.ON_WRITE:
+            self.validate()
+
+    def append_file(self, filename, layer=None, default_values={}, chunk_size=None):
+        """Append a file (Shapefile, GeoJSON, GeoPackage...)
+
+        With a chunk_size the file is read in chunks, see iter_file, each
+        chunk is validated according to the validation policy.
+        """
+        if chunk_size is not None:
+            for chunk in self.iter_file(
+                filename,
+                layer,
+                chunk_size,
+                default_values=default_values,
+                validate=False,
+            ):
+                self.add_frame(chunk)
+            return
 
-    def append_file(self, filename, layer=None, default_values={}):
         dataframe = gpd.read_file(filename, layer=layer, schema=self.fiona_schema)
 
         for dv in default_values.keys():
             dataframe[dv] = default_values[dv]
 
-        self.non_geom_schema.validate(dataframe)
+        self.add_frame(dataframe)
+
+    def iter_file(
+        self,
+        filename,
+        layer=None,
+        chunk_size=10000,
+        bbox=None,
+        default_values={},
+        validate=True,
+    ):
+        """Iterate over a file in chunks of at most chunk_size rows
+
+        The file is read in a single pass, only one chunk is in memory.
+        bbox:   optional (xmin, ymin, xmax, ymax), only the features that
+                intersect the bounding box are read
+        Yields GeoDataFrames validated and coerced against the schema (unless
+        validate is False, add_frame then applies the validation policy), the index
+        is the position of the row in the (filtered) file. The dataframe of this
+        HorusGeoDataFrame is not changed.
+        """
+        with fi.open(filename, layer=layer) as collection:
+            features = collection.filter(bbox=bbox) if bbox else iter(collection)
+            crs = collection.crs_wkt
+            start = 0
+            while True:
+                chunk = list(itertools.islice(features, chunk_size))
+                if len(chunk) == 0:
+                    return
+
+                dataframe = gpd.GeoDataFrame.from_features(chunk, crs=crs)
+                dataframe.index = pd.RangeIndex(start, start + len(chunk))
+                start += len(chunk)
 
-        self.dataframe = pd.concat([self.dataframe, dataframe])
+                for dv in default_values.keys():
+                    dataframe[dv] = default_values[dv]
+
+                if validate:
+                    dataframe = self.non_geom_schema.validate(dataframe)
+                yield dataframe
+
+    def append_geoparquet(self, filename, filters=None, default_values={}):
+        """Append a GeoParquet file
+
+        filters: optional pyarrow filters, e.g. [("rec_id", "=", 5)], only the
+                 matching row groups/rows are read.
+        """
+        if not pyarrow_found:
+            raise Exception("Install module 'pyarrow' to use GeoParquet.")
+
+        dataframe = gpd.read_parquet(filename, filters=filters)
+
+        for dv in default_values.keys():
+            dataframe[dv] = default_values[dv]
+
+        self.add_frame(dataframe)
+
+    ARROW_TYPES = {int: "int64", float: "float64", str: "string", bool: "bool"}
+    GEOPARQUET_TYPES = {
+        SchemaProvider.Geometry.Type.POINT_2D: "Point",
+        SchemaProvider.Geometry.Type.POINT_3D: "Point Z",
+    }
+
+    def arrow_schema(self):
+        """The schema as Arrow schema, geometries are WKB encoded (GeoParquet 1.0)"""
+        if not pyarrow_found:
+            raise Exception("Install module 'pyarrow' to use GeoParquet.")
+
+        fields = []
+        columns = {}
+        for field in self.schema.fields:
+            if type(field.type) is hg.SchemaProvider.Geometry:
+                fields.append(pyarrow.field(field.name, pyarrow.binary()))
+                columns[field.name] = {
+                    "encoding": "WKB",
+                    "geometry_types": [self.GEOPARQUET_TYPES[field.type.type]],
+                    "crs": CRS(self.crs).to_json_dict(),
+                }
+            else:
+                arrow_type = pyarrow.type_for_alias(self.ARROW_TYPES[field.type])
+                fields.append(pyarrow.field(field.name, arrow_type))
+
+        geo = {
+            "version": "1.0.0",
+            "primary_column": self.geometry_field,
+            "columns": columns,
+        }
+        return pyarrow.schema(fields, metadata={"geo": json.dumps(geo)})
+
+    def to_arrow(self, dataframe=None, schema=None):
+        """Convert (a part of) the dataframe into an Arrow table"""
+        if dataframe is None:
+            dataframe = self.dataframe
+        if schema is None:
+            schema = self.arrow_schema()
+
+        geometry_fields = [
+            field.name
+            for field in self.schema.fields
+            if type(field.type) is hg.SchemaProvider.Geometry
+        ]
+
+        arrays = []
+        for field in schema:
+            values = dataframe[field.name].to_numpy()
+            if field.name in geometry_fields:
+                values = shapely.to_wkb(values)
+            arrays.append(pyarrow.array(values, field.type, from_pandas=True))
+        return pyarrow.Table.from_arrays(arrays, schema=schema)
+
+    def write_geoparquet(self, filename, partition_by=None, row_group_size=None):
+        """Write the dataframe as GeoParquet
+
+        partition_by:   optional field name, e.g. "rec_id", every value
+                        (including null) is written as separate row group(s)
+        row_group_size: maximum number of rows per row group
+        """
+        schema = self.arrow_schema()
+        self.before_write()
+        dataframe = self.dataframe
+
+        with pyarrow.parquet.ParquetWriter(filename, schema) as writer:
+            if partition_by is None:
+                groups = [dataframe]
+            else:
+                groups = (
+                    group
+                    for _, group in dataframe.groupby(
+                        partition_by, dropna=False, sort=False
+                    )
+                )
+            for group in groups:
+                writer.write_table(
+                    self.to_arrow(group, schema), row_group_size=row_group_size
+                )
 
     def write_shapefile(self, filename):
+        self.before_write()
         self.dataframe.to_file(
             filename,
             crs=from_epsg(int(self.crs.split(":")[1])),
@@ -90,6 +445,7 @@ class HorusGeoDataFrame:
         )
 
     def write_geojson(self, filename):
+        self.before_write()
         self.dataframe.to_file(
             filename,
             driver="GeoJSON",
@@ -98,6 +454,7 @@ class HorusGeoDataFrame:
         )
 
     def write_geopackage(self, filename, layer):
+        self.before_write()
         self.dataframe.to_file(
             filename,
             layer=layer,
@@ -90,6 +90,49 @@ class EnuModel:
             ]
         )
 
+    def to_enu_array(self, geodeticPoints):
+        """
+        Geodetic to ENU for an array of points
+
+        Parameters
+        ----------
+
+        geodeticPoints : array of shape (n, 3)
+            WGS84 points (lon, lat, alt)
+
+        Results
+        -------
+            array of shape (n, 3), ENU points (meters, meters, meters)
+        """
+        points = numpy.asarray(geodeticPoints, dtype=float).reshape(-1, 3)
+        lon0, lat0, alt0 = self.geodeticPoint[:3]
+        return numpy.column_stack(
+            pymap3d.geodetic2enu(
+                points[:, 1], points[:, 0], points[:, 2], lat0, lon0, alt0
+            )
+        )
+
+    def to_geodetic_array(self, points):
+        """
+        ENU to Geodetic for an array of points
+
+        Parameters
+        ----------
+
+        points : array of shape (n, 3)
+            ENU points (meters, meters, meters)
+
+        Results
+        -------
+            array of shape (n, 3), WGS84 points (lon, lat, alt)
+        """
+        points = numpy.asarray(points, dtype=float).reshape(-1, 3)
+        lon0, lat0, alt0 = self.geodeticPoint[:3]
+        lat, lon, alt = pymap3d.enu2geodetic(
+            points[:, 0], points[:, 1], points[:, 2], lat0, lon0, alt0
+        )
+        return numpy.column_stack((lon, lat, alt))
+
     def rotate(self, point, angle):
         r = Rotation.from_euler("z", angle, degrees=True)
         return r.apply(point)
@@ -255,6 +298,98 @@ class Geographic:
             lines.append(Geographic.__get_line(*i))
         return Geographic.__get_point(lines)
 
+    @staticmethod
+    def rays(lat, lon, alt, yaw, pitch):
+        """Viewing rays of arrays of position vector components
+
+        Returns the ECEF origins and unit directions, both of shape (n, 3).
+        """
+        lat, lon, alt, yaw, pitch = (
+            numpy.asarray(v, dtype=float) for v in (lat, lon, alt, yaw, pitch)
+        )
+        origins = numpy.column_stack(pymap3d.geodetic2ecef(lat, lon, alt))
+
+        # ENU direction
+        e = numpy.cos(numpy.radians(pitch)) * numpy.sin(numpy.radians(yaw))
+        n = numpy.cos(numpy.radians(pitch)) * numpy.cos(numpy.radians(yaw))
+        u = numpy.sin(numpy.radians(pitch))
+
+        # rotated to ECEF
+        sin_lat, cos_lat = numpy.sin(numpy.radians(lat)), numpy.cos(numpy.radians(lat))
+        sin_lon, cos_lon = numpy.sin(numpy.radians(lon)), numpy.cos(numpy.radians(lon))
+        directions = numpy.column_stack(
+            (
+                -sin_lon * e - sin_lat * cos_lon * n + cos_lat * cos_lon * u,
+                cos_lon * e - sin_lat * sin_lon * n + cos_lat * sin_lon * u,
+                cos_lat * n + sin_lat * u,
+            )
+        )
+        directions /= numpy.linalg.norm(directions, axis=1)[:, numpy.newaxis]
+        return origins, directions
+
+    @staticmethod
+    def closest_approach(origins1, directions1, origins2, directions2):
+        """Closest approach of pairs of rays (unit directions), element-wise
+
+        Returns the distances between the rays and the parameters t1, t2 of
+        the closest points (origin + t * direction) on both rays.
+        For parallel rays t1 is 0.
+        """
+        w = origins1 - origins2
+        b = numpy.einsum("ij,ij->i", directions1, directions2)
+        d = numpy.einsum("ij,ij->i", directions1, w)
+        e = numpy.einsum("ij,ij->i", directions2, w)
+        denom = 1.0 - b * b
+
+        parallel = denom < 1e-12
+        denom = numpy.where(parallel, 1.0, denom)
+        t1 = numpy.where(parallel, 0.0, (b * e - d) / denom)
+        t2 = numpy.where(parallel, e, (e - b * d) / denom)
+
+        gap = (
+            w + t1[:, numpy.newaxis] * directions1 - t2[:, numpy.newaxis] * directions2
+        )
+        return numpy.linalg.norm(gap, axis=1), t1, t2
+
+    @staticmethod
+    def triangulate_rays(origins, directions, labels):
+        """Triangulate the rays of every label in a single pass
+
+        labels: array of integer labels (0 .. k-1), one per ray
+
+        Returns an array of shape (k, 3) of (lat, lon, alt) per label,
+        the same as triangulate would return for the rays of that label.
+        Labels with less than two rays or only parallel rays are NaN.
+        """
+        labels = numpy.asarray(labels, dtype=numpy.intp)
+        k = labels.max() + 1 if len(labels) > 0 else 0
+
+        # relative to the first ray of every label, for numerical precision
+        first = numpy.full(k, len(labels), dtype=numpy.intp)
+        numpy.minimum.at(first, labels, numpy.arange(len(labels)))
+        reference = origins[first]
+        relative = origins - reference[labels]
+
+        m = (
+            numpy.identity(3)
+            - directions[:, :, numpy.newaxis] * directions[:, numpy.newaxis, :]
+        )
+        left = numpy.zeros((k, 3, 3))
+        right = numpy.zeros((k, 3))
+        numpy.add.at(left, labels, m)
+        numpy.add.at(right, labels, numpy.einsum("ijk,ik->ij", m, relative))
+
+        count = numpy.bincount(labels, minlength=k)
+        solvable = (count > 1) & (numpy.abs(numpy.linalg.det(left)) > 1e-12)
+        output = numpy.full((k, 3), numpy.nan)
+        output[solvable] = (
+            numpy.linalg.solve(left[solvable], right[solvable][:, :, numpy.newaxis])[
+                :, :, 0
+            ]
+            + reference[solvable]
+        )
+        return numpy.column_stack(pymap3d.ecef2geodetic(*output.T))
+
 
 class SchemaProvider:
     ### Provides database schemas ###
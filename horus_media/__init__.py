@@ -6,7 +6,9 @@ from dataclasses import dataclass
 from PIL import Image
 from itertools import chain
 from enum import Enum
+from concurrent.futures import ThreadPoolExecutor
 
+import numpy
 import urllib.parse
 import io
 import math
@@ -86,6 +88,13 @@ class Grid:
             ay = y * self.section_height - h_max
             self.__map[index] = Section(x, y, ax, ay, index)
 
+        # angular interval [min, min + size) of every column and row
+        self.__w_offset = -w_max
+        self.__h_offset = -h_max
+        self.__col_min = [x * self.section_width - w_max for x in range(c)]
+        self.__row_min = [y * self.section_height - h_max for y in range(r)]
+        self.__filter_cache = {}
+
     def __iter__(self):
         """Returns the Iterator object"""
         return (section for section in self.__map.values())
@@ -118,6 +127,9 @@ class Grid:
     def filter(self, fov=None, w_min=-180, w_max=180, h_min=-90, h_max=90):
         """
         fov is a Box with min, max points
+
+        Returns an iterator over the sections that overlap the fov, the
+        sections of a fov are computed once.
         """
         if fov:
             w_min = fov.min.x
@@ -137,20 +149,67 @@ class Grid:
         if w_max_wrapped > 180:
             w_max_wrapped = -360 + w_max_wrapped
 
-        h = self.Comparator(h_min, h_max, self.section_height)
+        key = (w_min_wrapped, w_max_wrapped, h_min, h_max)
+        sections = self.__filter_cache.get(key)
+        if sections is None:
+            if len(self.__filter_cache) >= Grid.FILTER_CACHE_SIZE:
+                self.__filter_cache.clear()
+            sections = self.__filter(*key)
+            self.__filter_cache[key] = sections
+        return iter(sections)
+
+    FILTER_CACHE_SIZE = 1024
+
+    @staticmethod
+    def __range(value_min, value_max, offset, size, count, mins):
+        """Indices of the intervals [mins[k], mins[k] + size) that overlap
+        (value_min, value_max), the candidates are computed arithmetically
+        and checked like Comparator does.
+        """
+        first = max(math.floor((value_min - offset) / size) - 1, 0)
+        last = min(math.ceil((value_max - offset) / size) + 1, count)
+        return [
+            k
+            for k in range(first, last)
+            if value_min < (mins[k] + size) and mins[k] < value_max
+        ]
+
+    def __filter(self, w_min_wrapped, w_max_wrapped, h_min, h_max):
+        def cols(value_min, value_max):
+            return Grid.__range(
+                value_min,
+                value_max,
+                self.__w_offset,
+                self.section_width,
+                self.cols,
+                self.__col_min,
+            )
+
+        rows = Grid.__range(
+            h_min,
+            h_max,
+            self.__h_offset,
+            self.section_height,
+            self.rows,
+            self.__row_min,
+        )
         if w_min_wrapped < w_max_wrapped:
-            w = self.Comparator(w_min_wrapped, w_max_wrapped, self.section_width)
-            for section in self.__map.values():
-                if section.ay in h and section.ax in w:
-                    yield section
+            columns = cols(w_min_wrapped, w_max_wrapped)
         elif w_min_wrapped > w_max_wrapped:
             assert w_max_wrapped >= -180
             assert w_min_wrapped <= 180
-            w_left = self.Comparator(-180, w_max_wrapped, self.section_width)
-            w_right = self.Comparator(w_min_wrapped, 180, self.section_width)
-            for section in self.__map.values():
-                if section.ay in h and (section.ax in w_left or section.ax in w_right):
-                    yield section
+            columns = sorted(
+                set(cols(-180, w_max_wrapped)) | set(cols(w_min_wrapped, 180))
+            )
+        else:
+            columns = []
+
+        # in index order, top row first
+        return tuple(
+            self.__map[(self.rows - 1 - y) * self.cols + x]
+            for y in reversed(rows)
+            for x in columns
+        )
 
 
 @dataclass(frozen=True)
@@ -399,9 +458,21 @@ class ImageRequestBuilder:
 
 
 class ImageProvider:
+    class Output(Enum):
+        """The image type of a combined Result
+
+        JPEG:  an encoded JPEG image (io.BytesIO)
+        ARRAY: a numpy array (height x width x 3, uint8, RGB)
+        IMAGE: a PIL image
+        """
+
+        JPEG = "jpeg"
+        ARRAY = "array"
+        IMAGE = "image"
+
     @dataclass(frozen=True)
     class Result:
-        image: io.BytesIO
+        image: io.BytesIO  # or numpy.ndarray, PIL.Image.Image, see Output
         fov: Rect
         w: int
         h: int
@@ -425,18 +496,53 @@ class ImageProvider:
 
             return Point(math.floor(x), math.floor(y))
 
-    def __init__(self, grid=Grid()):
+    def __init__(self, grid=Grid(), workers=None):
+        """workers: the maximum number of threads decoding sections in combine"""
         self.grid = grid
+        self.workers = workers
 
-    def fetch(self, image_request, w=None, h=None):
-        return self.Result(
-            io.BytesIO(image_request.result()),
-            Rect(0, 0, w, h) if w and h else Rect(0, 0, 1, 1),
-            w if w else 0,
-            h if h else 0,
-        )
+    def fetch(self, image_request, w=None, h=None, size=None, output=Output.JPEG):
+        """Wrap the image of a fetched request
+
+        The image is passed on as is, unless it has to be reduced to fit in
+        size (Size) or another output is requested. JPEG images are then
+        decoded at a reduced resolution (1/2, 1/4 or 1/8, see Image.draft).
+
+        w, h is the size of an image that is passed on as is; a reduced image
+        gets the size of its pixels, so w, h and size exclude each other.
+        """
+        if size is not None and (w is not None or h is not None):
+            raise ValueError("Pass either the image size (w, h) or size to reduce to.")
+
+        if size is None and output == self.Output.JPEG:
+            return self.Result(
+                io.BytesIO(image_request.result()),
+                Rect(0, 0, w, h) if w and h else Rect(0, 0, 1, 1),
+                w if w else 0,
+                h if h else 0,
+            )
 
-    def combine(self, image_requests, w, h):
+        with Image.open(io.BytesIO(image_request.result())) as image:
+            if size is not None:
+                image.thumbnail((size.width, size.height))
+            if image.mode != "RGB":
+                image = image.convert("RGB")
+            pixels = numpy.asarray(image)
+        w, h = pixels.shape[1], pixels.shape[0]
+        return self.Result(self.to_output(pixels, output), Rect(0, 0, w, h), w, h)
+
+    def combine(self, image_requests, w, h, output=Output.JPEG):
+        """Stitch the sections of the image requests
+
+        The sections are decoded in parallel into one numpy array, the
+        stitched image is only encoded (JPEG) for output Output.JPEG.
+
+        w, h is the size of a section in the stitched image. Sections larger
+        than that are decoded at a reduced resolution (1/2, 1/4 or 1/8, see
+        Image.draft) and scaled to fit. Request the sections at
+        Scales.from_size(w) to fetch no more pixels than needed.
+        """
+        image_requests = list(image_requests)
         rows = set()
         cols = set()
         for req in image_requests:
@@ -448,27 +554,76 @@ class ImageProvider:
         col_map = self.set_to_map(self.wrap(sorted(cols)))
         row_index_shift = len(rows) - 1
 
-        stitched = Image.new("RGB", (w * len(col_map), h * len(row_map)))
+        stitched = numpy.zeros((h * len(row_map), w * len(col_map), 3), numpy.uint8)
         fov = Rect(math.inf, math.inf, 0, 0)
         fov.width = len(col_map) * self.grid.section_width
         fov.height = len(row_map) * self.grid.section_height
 
+        placements = []
         for req in image_requests:
             r = row_map[req.section.y]
             c = col_map[req.section.x]
             fov.y = min(req.section.ay, fov.y)
             fov.x = min(req.section.ax, fov.x)
+            target = stitched[(row_index_shift - r) * h :, c * w :][:h, :w]
+            placements.append((req, target))
 
-            try:
-                image = Image.open(io.BytesIO(req.result()))
-                stitched.paste(image, (c * w, (row_index_shift - r) * h))
-            except Exception as exception:
-                logging.error(
-                    f"{exception}. Stitching section {req.section} from {req.url}"
-                )
-        image = io.BytesIO()
-        stitched.save(image, format="jpeg", quality=95)
-        return self.Result(image, fov, stitched.width, stitched.height)
+        if len(placements) > 1:
+            with ThreadPoolExecutor(self.workers) as executor:
+                list(executor.map(lambda p: self.__decode_into(*p), placements))
+        else:
+            for placement in placements:
+                self.__decode_into(*placement)
+
+        return self.Result(
+            self.to_output(stitched, output), fov, stitched.shape[1], stitched.shape[0]
+        )
+
+    @staticmethod
+    def __decode_into(req, target):
+        """Decode the section image of the request into the target array"""
+        try:
+            with Image.open(io.BytesIO(req.result())) as image:
+                h, w = target.shape[:2]
+                if image.width > w or image.height > h:
+                    image.draft("RGB", (w, h))
+                    if image.size != (w, h):
+                        image = image.resize((w, h))
+                if image.mode != "RGB":
+                    image = image.convert("RGB")
+                pixels = numpy.asarray(image)[:h, :w]
+                target[: pixels.shape[0], : pixels.shape[1]] = pixels
+        except Exception as exception:
+            logging.error(
+                f"{exception}. Stitching section {req.section} from {req.url}"
+            )
+
+    @classmethod
+    def to_output(cls, array, output=Output.JPEG, quality=95):
+        """Convert an image array (height x width x 3, uint8) to the output type"""
+        if output == cls.Output.ARRAY:
+            return array
+        image = Image.fromarray(array)
+        if output == cls.Output.IMAGE:
+            return image
+        encoded = io.BytesIO()
+        image.save(encoded, format="jpeg", quality=quality)
+        return encoded
+
+    @classmethod
+    def encode(cls, result, quality=95):
+        """Encode the (array or PIL) image of a combined result as JPEG"""
+        image = result.image
+        if isinstance(image, io.BytesIO):
+            return result
+        if isinstance(image, Image.Image):
+            image = numpy.asarray(image.convert("RGB"))
+        return cls.Result(
+            cls.to_output(image, cls.Output.JPEG, quality),
+            result.fov,
+            result.w,
+            result.h,
+        )
 
     @classmethod
     def wrap(cls, cols):
@@ -21,8 +21,9 @@ db.resolve()
 db.show_info()
 
 # Iterate over data
+field_names_map = db.get_field_names_map()
 for row in db.query():
-    for fieldname, info in db.get_field_names_map().items():
+    for fieldname, info in field_names_map.items():
         # print(row[info.idx])
         pass
 
@@ -2,14 +2,17 @@ from horus_camera import SphericalCamera
 from horus_gis import GeographicLocation
 from horus_db import Frames, Frame
 from horus_spatialite import Spatialite, FrameMatchedIterator
-from pyproj import Geod
 from horus_geometries import Geometry_proj
+from horus_analytics import Metric, distance
 import geopandas as gpd
-import pandas as pd
 import sys
 from os import path
 import traceback
 import math
+import json
+import shapely
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 
 from . import util
 
@@ -35,22 +38,65 @@ parser.add_argument(
 parser.add_argument(
     "--recording-id", type=int, help="Optionally provide a the static recording id."
 )
+parser.add_argument(
+    "--sqlite-bbox",
+    type=float,
+    nargs=4,
+    metavar=("XMIN", "YMIN", "XMAX", "YMAX"),
+    help="Optionally only take snapshots of the geometries within the bounding box",
+)
+parser.add_argument(
+    "--db-pool-size",
+    type=int,
+    default=0,
+    help="match frames ahead of the snapshots using a pool of database connections (not with --processes)",
+)
+parser.add_argument(
+    "--output",
+    type=str,
+    default="output/snapshots.geojson",
+    help="the output records, written in chunks as GeoJSON (.geojson), GeoJSONSeq (.geojsonl, stays readable when interrupted), GeoPackage (.gpkg) or GeoParquet (.parquet)",
+)
+parser.add_argument(
+    "--output-chunk-size",
+    type=int,
+    default=1000,
+    help="number of output records buffered before they are written",
+)
+parser.add_argument(
+    "--processes",
+    type=int,
+    default=1,
+    help="number of worker processes rendering snapshots, each with its own database and server connection",
+)
+parser.add_argument(
+    "--queue-size",
+    type=int,
+    default=64,
+    help="maximum number of geometries queued for the worker processes (at least 1)",
+)
 util.add_database_arguments(parser)
 util.add_server_arguments(parser)
 
-args = parser.parse_args()
-if args.sqlite_db is None:
-    print("A sqlite database should be provided")
-    exit()
+# Connections of the (worker) process, see connect(..)
+connection = None
+sp_camera: SphericalCamera = None
 
-connection = util.get_connection(args)
+# sqlite_frame_idx_field = "Frame_numb"
+output_sink = None
+geometry_proj = Geometry_proj()
 
-sp_camera = SphericalCamera()
-sp_camera.set_network_client(util.get_client(args))
 
-# sqlite_frame_idx_field = "Frame_numb"
-output_database = None
-geod = Geod(ellps="WGS84")
+def connect(args):
+    """
+    Connect this process to the database and the media server
+    """
+    global connection, sp_camera
+
+    connection = util.get_connection(args)
+
+    sp_camera = SphericalCamera()
+    sp_camera.set_network_client(util.get_client(args))
 
 
 def compute_heading(long_0, lat_0, long_1, lat_1):
@@ -116,27 +162,28 @@ class Look_at:
     def __init__(self, frame, geometry):
         self.frame = frame
         self.geometry = geometry
-        self.gp = Geometry_proj()
 
     def to_geographic_loc_list(self):
-        return self.gp.to_geographic(self.geometry)
+        return geometry_proj.to_geographic(self.geometry)
 
 
-def add_to_output(db, frame, geometry, filename, error, sub_id, matched_frame):
+def create_record(frame, geometry, filename, error, sub_id, matched_frame):
     """
-    Add the current geometry and attributes to the output database
+    Create the output record of the current geometry and attributes
     """
-    global output_database
-
     record = {}
-    record["geometry"] = gpd.GeoSeries(geometry)
+    record["geometry"] = geometry
     record["snapshot"] = filename
     record["snapshot_error"] = error
     record["sub_id"] = sub_id
     record["frame_index"] = frame.index if frame else None
     record["recording_id"] = frame.recordingid if frame else None
     record["distance"] = (
-        geod.line_length(*zip(*[frame.get_location()[:2], geometry.centroid.coords[0]]))
+        distance(
+            *frame.get_location()[:2],
+            *geometry.centroid.coords[0][:2],
+            metric=Metric.GEODESIC,
+        )
         if frame
         else None
     )
@@ -144,12 +191,156 @@ def add_to_output(db, frame, geometry, filename, error, sub_id, matched_frame):
     for k, v in matched_frame.metadata.items():
         record[k] = v
 
-    gdf = gpd.GeoDataFrame(record)
+    return record
 
-    if output_database is None:
-        output_database = gdf
-    else:
-        output_database = pd.concat([output_database, gdf])
+
+class OutputSink:
+    """
+    Output records buffered in columnar lists and written in chunks.
+
+    The records are appended to the output file every 'chunk_size' records,
+    the format follows the file extension: GeoJSONSeq (.geojsonl, one
+    feature per line), GeoJSON (.geojson), GeoPackage (.gpkg) or
+    GeoParquet (.parquet, requires pyarrow).
+    The chunks written before an interruption are kept; GeoJSONSeq and
+    GeoPackage files stay readable, a GeoJSON file misses its closing
+    brackets unless the sink is closed.
+    """
+
+    FIELDS = {
+        "snapshot": "str",
+        "snapshot_error": "str",
+        "sub_id": "int",
+        "frame_index": "int",
+        "recording_id": "int",
+        "distance": "float",
+        "image_index_entries.file": "str",
+        "image_index_entries.path": "str",
+    }
+
+    def __init__(self, filename, chunk_size=1000, layer="snapshots"):
+        self.filename = filename
+        self.chunk_size = chunk_size
+        self.layer = layer
+        self.extension = path.splitext(filename)[1].lower()
+        if self.extension not in (".geojsonl", ".geojson", ".gpkg", ".parquet"):
+            raise Exception(f"OutputSink unsupported output format '{filename}'.")
+
+        self.columns = {name: [] for name in ["geometry", *self.FIELDS]}
+        self.size = 0
+        self.count = 0
+        self.file = None
+        self.writer = None
+
+    def add(self, record):
+        for name, values in self.columns.items():
+            values.append(record.get(name))
+        self.size += 1
+        if self.size >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        if self.size == 0:
+            return
+
+        if self.extension == ".geojsonl":
+            self.write_geojsonseq()
+        elif self.extension == ".geojson":
+            self.write_geojson()
+        elif self.extension == ".gpkg":
+            self.write_geopackage()
+        else:
+            self.write_geoparquet()
+
+        self.count += self.size
+        self.size = 0
+        for values in self.columns.values():
+            values.clear()
+
+    def close(self):
+        self.flush()
+        if self.file is not None:
+            if self.extension == ".geojson":
+                self.file.write("\n]}\n")
+            self.file.close()
+            self.file = None
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+    def features(self):
+        names = list(self.FIELDS)
+        for i, geometry in enumerate(self.columns["geometry"]):
+            yield {
+                "type": "Feature",
+                "properties": {name: self.columns[name][i] for name in names},
+                "geometry": shapely.geometry.mapping(geometry),
+            }
+
+    def write_geojsonseq(self):
+        if self.file is None:
+            self.file = open(self.filename, "w")
+
+        for feature in self.features():
+            self.file.write(json.dumps(feature) + "\n")
+        self.file.flush()
+
+    def write_geojson(self):
+        if self.file is None:
+            self.file = open(self.filename, "w")
+            self.file.write('{"type": "FeatureCollection", "features": [\n')
+
+        for i, feature in enumerate(self.features()):
+            if self.count + i > 0:
+                self.file.write(",\n")
+            self.file.write(json.dumps(feature))
+        self.file.flush()
+
+    def write_geopackage(self):
+        gdf = gpd.GeoDataFrame(
+            {name: self.columns[name] for name in self.FIELDS},
+            geometry=self.columns["geometry"],
+            crs="EPSG:4326",
+        )
+        gdf.to_file(
+            self.filename,
+            layer=self.layer,
+            driver="GPKG",
+            schema={"geometry": "Unknown", "properties": self.FIELDS},
+            mode="w" if self.count == 0 else "a",
+        )
+
+    def write_geoparquet(self):
+        import pyarrow
+        import pyarrow.parquet
+
+        types = {"str": pyarrow.string(), "int": pyarrow.int64()}
+        arrays = [
+            pyarrow.array(self.columns[name], types.get(kind, pyarrow.float64()))
+            for name, kind in self.FIELDS.items()
+        ]
+        arrays.append(
+            pyarrow.array(shapely.to_wkb(self.columns["geometry"]), pyarrow.binary())
+        )
+        table = pyarrow.Table.from_arrays(arrays, names=[*self.FIELDS, "geometry"])
+
+        if self.writer is None:
+            geo = {
+                "version": "1.0.0",
+                "primary_column": "geometry",
+                "columns": {"geometry": {"encoding": "WKB", "geometry_types": []}},
+            }
+            schema = table.schema.with_metadata({"geo": json.dumps(geo)})
+            self.writer = pyarrow.parquet.ParquetWriter(self.filename, schema)
+
+        self.writer.write_table(table)
+
+
+def add_to_output(record):
+    """
+    Add the record to the output
+    """
+    output_sink.add(record)
 
 
 def try_find_frame(geometry, mf: FrameMatchedIterator.MatchedFrame):
@@ -169,81 +360,45 @@ def try_find_frame(geometry, mf: FrameMatchedIterator.MatchedFrame):
         return GEOM_HEADING_FRAME_SELECTOR(geometry, cursor)
 
 
-def look_at_point(point, mf: FrameMatchedIterator.MatchedFrame, side):
+def look_at_geometry(geometry, mf: FrameMatchedIterator.MatchedFrame):
     """
-    Transform a 'Point' geometry into a square of sides 'side'x'side' in meters.
+    Plan the look at polygons of a geometry (and its parts):
+    - 'Point': a square of 0.5x0.5 meters
+    - 'LineString': buffered by 0.1 meter, split into sub LineStrings of
+      maximum 5 meters, each with a frame from the same recording if found
+    - 'Polygon': the polygon itself
     """
-    assert point.geom_type == "Point"
-    gp = Geometry_proj()
-    square = gp.point_to_square(point, side)
-    return [Look_at(mf.frame, square)]
-
-
-def look_at_linestring(
-    linestring,
-    mf: FrameMatchedIterator.MatchedFrame,
-    max_length,
-    offset,
-):
-    """
-    Transform a 'LineString' geometry into sub LineStrings of maximum length of 'max_length' in meters.
-    """
-    assert linestring.geom_type == "LineString"
-    gp = Geometry_proj()
-
-    if geod.geometry_length(linestring) > max_length:
-        linestrings = gp.split_linestring(linestring, max_length)
+    plan = geometry_proj.look_at_polygons(
+        [geometry], point_width=0.5, max_length=5, offset=0.1
+    )
 
-        look_at_all_sub_string = []
-        for w in linestrings:
-            frame = try_find_frame(w, mf)
+    look_at_all = []
+    for piece, polygon, split in zip(plan.piece, plan.polygon, plan.split):
+        if split:
+            frame = try_find_frame(piece, mf)
 
             if not frame is None:
                 mf.frame = frame
 
-            look_at_all_sub_string.append(
-                look_at_linestring(w, mf, max_length, offset)[0]
-            )
-
-        return look_at_all_sub_string
+        look_at_all.append(Look_at(mf.frame, polygon))
 
-    return [Look_at(mf.frame, gp.buffer(linestring, offset))]
+    return look_at_all
 
 
-def look_at_polygon(polygon, mf: FrameMatchedIterator.MatchedFrame):
+def take_snapshot(db, mf: FrameMatchedIterator.MatchedFrame):
     """
-    Transform a 'Polygon' geometry into a collection of Polygons.
+    Take the snapshots of the geometry of a matched frame, returns the output records
     """
-    assert polygon.geom_type == "Polygon"
-    return [Look_at(mf.frame, polygon)]
-
-
-def take_snapshot(db, mf: FrameMatchedIterator.MatchedFrame):
     geometry = db.get_geometry(mf.spatialite_cursor)[db.geometry_field_name]
 
-    geometries = []
-    if geometry.geom_type.startswith("Multi"):
-        for geom in geometry.geoms:
-            geometries.append(geom)
-    else:
-        geometries.append(geometry)
-
     width = 800
-    look_at_all: [Look_at] = []
-    for geom in geometries:
-        if geom.geom_type == "Polygon":
-            look_at_all = [*look_at_all, *look_at_polygon(geom, mf)]
-        elif geom.geom_type == "LineString":
-            look_at_all = [*look_at_all, *look_at_linestring(geom, mf, 5, 0.1)]
-        elif geom.geom_type == "Point":
-            look_at_all = [*look_at_all, *look_at_point(geom, mf, 0.5)]
-        else:
-            print("Not supported", geom.geom_type)
+    look_at_all: [Look_at] = look_at_geometry(geometry, mf)
 
     nr_snapshots = len(look_at_all)
+    records = []
 
     for x, look_at in enumerate(look_at_all):
-        look_at_geometry = look_at.to_geographic_loc_list()
+        geo_locations = look_at.to_geographic_loc_list()
         db_id = mf.spatialite_cursor[db.field_info_map["rowid"].idx]
         print(
             "Snapshot:",
@@ -268,9 +423,9 @@ def take_snapshot(db, mf: FrameMatchedIterator.MatchedFrame):
         if mf.recording != None and look_at.frame != None:
             try:
                 sp_camera.set_frame(mf.recording, look_at.frame)
-                size = sp_camera.look_at_all(look_at_geometry, width)
+                size = sp_camera.look_at_all(geo_locations, width)
                 spherical_image = sp_camera.crop_to_geometry(
-                    sp_camera.acquire(size), look_at_geometry
+                    sp_camera.acquire(size, manual_fetch=True), geo_locations
                 )
                 with open(filename, "wb") as image_file:
                     image_file.write(spherical_image.get_image().getvalue())
@@ -284,44 +439,151 @@ def take_snapshot(db, mf: FrameMatchedIterator.MatchedFrame):
             error = f"No frame found within {DISTANCE_MIN}-{DISTANCE_MAX} meters from centroid of geometry."
             print("Error:", error)
             print("Spatialite cursor:", mf.spatialite_cursor)
-        add_to_output(db, look_at.frame, look_at.geometry, filename, error, x + 1, mf)
-
-
-db = Spatialite(args.sqlite_db)
-if not args.recordings_on_disk is None:
-    db.set_recordings_on_disk_root_folder(args.recordings_on_disk)
-if not args.sqlite_recording is None:
-    db.set_recording_field(args.sqlite_recording)
-if not args.sqlite_framenr is None:
-    db.set_frame_index_field(args.sqlite_framenr)
-if not args.sqlite_geometry is None:
-    db.set_geometry_field_name(args.sqlite_geometry)
-    db.blob_contains_geometry(args.sqlite_geometry)
-db.set_remote_db_connection(connection)
-db.open()
-db.resolve()
-db.show_info()
-
-fmi: FrameMatchedIterator = db.get_matched_frames_iterator()
-fmi.set_distance_limits(DISTANCE_MIN, DISTANCE_MAX)
-fmi.set_frame_limit(FRAME_LIMIT)
-fmi.set_frame_selector(GEOM_HEADING_FRAME_SELECTOR)
-if not args.recording_id is None:
-    fmi.set_static_recording_by_id(args.recording_id)
-
-mf: FrameMatchedIterator.MatchedFrame = next(fmi, None)
-
-while mf != None:
-    assert mf.spatialite_cursor != None
+        records.append(
+            create_record(look_at.frame, look_at.geometry, filename, error, x + 1, mf)
+        )
+
+    return records
+
+
+def try_take_snapshot(db, mf: FrameMatchedIterator.MatchedFrame):
     try:
-        take_snapshot(db, mf)
+        return take_snapshot(db, mf)
     except Exception as e:
         print("Exception:", e)
         print("Properties:", mf.properties)
         print("Metadata:", mf.metadata)
-    mf = next(fmi, None)
+    return []
+
+
+def open_database(args):
+    db = Spatialite(args.sqlite_db)
+    if not args.recordings_on_disk is None:
+        db.set_recordings_on_disk_root_folder(args.recordings_on_disk)
+    if not args.sqlite_recording is None:
+        db.set_recording_field(args.sqlite_recording)
+    if not args.sqlite_framenr is None:
+        db.set_frame_index_field(args.sqlite_framenr)
+    if not args.sqlite_geometry is None:
+        db.set_geometry_field_name(args.sqlite_geometry)
+        db.blob_contains_geometry(args.sqlite_geometry)
+    db.set_remote_db_connection(connection)
+    db.open()
+    db.resolve()
+    return db
+
+
+def configure_iterator(fmi: FrameMatchedIterator, args):
+    fmi.set_distance_limits(DISTANCE_MIN, DISTANCE_MAX)
+    fmi.set_frame_limit(FRAME_LIMIT)
+    fmi.set_frame_selector(GEOM_HEADING_FRAME_SELECTOR)
+    if not args.recording_id is None:
+        fmi.set_static_recording_by_id(args.recording_id)
+
+
+# State of a worker process, see init_worker(..)
+worker_db: Spatialite = None
+worker_fmi: FrameMatchedIterator = None
+
+
+def init_worker(args):
+    """
+    Initialize a worker process with its own connections and spatialite database
+    """
+    global worker_db, worker_fmi
+
+    connect(args)
+    worker_db = open_database(args)
+    worker_fmi = FrameMatchedIterator(None, connection, worker_db)
+    configure_iterator(worker_fmi, args)
 
-db.close()
 
-if not output_database is None:
-    output_database.to_file("output/snapshots.geojson", driver="GeoJSON")
+def render_worker(mf: FrameMatchedIterator.MatchedFrame):
+    """
+    Resolve the frame of a prepared matched frame and take its snapshots
+    """
+    try:
+        worker_fmi.resolve(mf)
+    except Exception as e:
+        print("Exception:", e)
+        print("Properties:", mf.properties)
+        return []
+    return try_take_snapshot(worker_db, mf)
+
+
+def render_parallel(fmi: FrameMatchedIterator, args):
+    """
+    Render the snapshots using a pool of worker processes.
+
+    The rows are prepared in order by this process, at most 'queue_size' are
+    pending. The records are added to the output in row order, the snapshot
+    file names only depend on the row, so the output does not depend on
+    the number of processes.
+    """
+    pending = deque()
+    with ProcessPoolExecutor(
+        args.processes, initializer=init_worker, initargs=(args,)
+    ) as executor:
+        for row in fmi.cursor:
+            pending.append(executor.submit(render_worker, fmi.prepare(row)))
+            while len(pending) >= args.queue_size:
+                for record in pending.popleft().result():
+                    add_to_output(record)
+
+        while len(pending) > 0:
+            for record in pending.popleft().result():
+                add_to_output(record)
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    if args.sqlite_db is None:
+        print("A sqlite database should be provided")
+        exit()
+    if args.queue_size < 1:
+        parser.error("--queue-size should be at least 1")
+    if args.processes > 1 and args.db_pool_size > 0:
+        parser.error("--db-pool-size can not be combined with --processes")
+
+    connect(args)
+
+    db = open_database(args)
+    db.show_info()
+
+    output_sink = OutputSink(args.output, args.output_chunk_size)
+
+    # close the sink on any exit, the records rendered so far stay readable
+    try:
+        if args.processes > 1:
+            fmi: FrameMatchedIterator = db.get_matched_frames_iterator(
+                bbox=args.sqlite_bbox
+            )
+            configure_iterator(fmi, args)
+            render_parallel(fmi, args)
+
+        else:
+            pool = None
+            if args.db_pool_size > 0:
+                pool = util.get_connection_pool(args, args.db_pool_size)
+                fmi: FrameMatchedIterator = db.get_pipelined_matched_frames_iterator(
+                    pool, workers=args.db_pool_size, bbox=args.sqlite_bbox
+                )
+            else:
+                fmi: FrameMatchedIterator = db.get_matched_frames_iterator(
+                    bbox=args.sqlite_bbox
+                )
+            configure_iterator(fmi, args)
+
+            try:
+                with fmi:
+                    for mf in fmi:
+                        assert mf.spatialite_cursor != None
+                        for record in try_take_snapshot(db, mf):
+                            add_to_output(record)
+            finally:
+                if pool is not None:
+                    pool.closeall()
+    finally:
+        output_sink.close()
+
+    db.close()
@@ -17,7 +17,7 @@ from horus_db import Frames, Recordings, Frame, Recording
 from horus_gis import SchemaProvider
 from . import util
 from horus_geopandas import HorusGeoDataFrame
-import geopandas as gpd
+from shapely.geometry import Point
 
 
 def fill_record(
@@ -30,9 +30,7 @@ def fill_record(
     detection,
 ):
     # update geometry
-    record["geometry"] = gpd.points_from_xy(
-        x=[grp.geo_location.lon], y=[grp.geo_location.lat]
-    )
+    record["geometry"] = Point(grp.geo_location.lon, grp.geo_location.lat)
     # Record
     record["rec_id"] = grp.recording_id
     record["frame_idx"] = grp.frame_index
@@ -229,8 +227,8 @@ for frame_id in detections_per_frame:
         detection = Detection(camera.clone())
         detection.load(detections_per_frame[frame_id][detection_id])
 
-        # -- obtain database frame
-        record = database.new_frame()
+        # -- new database record
+        record = {}
 
         # -- set the camera
         sp_camera.set_horizontal_fov(detection.camera.cam_hor_fov)
@@ -260,8 +258,8 @@ for frame_id in detections_per_frame:
         fill_record(
             record, frame, grp, detection_parms, sp_camera, spherical_image, detection
         )
-        record["usr_id"] = database.dataframe.shape[0]
-        database.add_frame(record)
+        record["usr_id"] = len(database)
+        database.add_record(record)
 
 
 database.write_shapefile(os.path.join(output_dir, "single_measurement.shp"))
@@ -1,6 +1,6 @@
 from horus_gis import SchemaProvider, PositionVector, Geographic
 from horus_geopandas import HorusGeoDataFrame
-import geopandas as gpd
+from shapely.geometry import Point
 import os
 
 ### Read Data ####
@@ -52,11 +52,11 @@ for vpp in surf_vpp_per_cluster:
     lon = geolocation_per_cluster[vpp][1]
     alt = geolocation_per_cluster[vpp][2]
 
-    record = database.new_frame()
-    record["geometry"] = gpd.points_from_xy(x=[lon], y=[lat], z=[alt])
-    record["clstr_id"] = vpp
-    record["clstr_conf"] = confidence_per_cluster[vpp]
-    database.add_frame(record)
+    database.add_record(
+        geometry=Point(lon, lat, alt),
+        clstr_id=vpp,
+        clstr_conf=confidence_per_cluster[vpp],
+    )
 
 
 database.write_shapefile("output/cluster_locations.shp")
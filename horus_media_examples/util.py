@@ -5,6 +5,7 @@ Example utility
 """
 
 import psycopg2
+import psycopg2.pool
 import argparse
 import logging
 
@@ -171,6 +172,16 @@ def get_connection(args):
         exit()
 
 
+def get_connection_pool(args, size):
+    try:
+        return psycopg2.pool.ThreadedConnectionPool(
+            1, size, get_database_connection_string(args)
+        )
+    except psycopg2.OperationalError as exception:
+        logging.error(f"{exception} Connecting to database")
+        exit()
+
+
 def get_geometry(args, altitude_next=None):
     return Geometry(
         args.geom_scale,
@@ -4,6 +4,9 @@
 import os
 import pathlib
 import glob
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from xml.etree import ElementTree
 from horus_db import Recording, Recordings, Frame, Frames
 
@@ -21,6 +24,10 @@ except ModuleNotFoundError as e:
 class Spatialite:
     """
     Database used for making annotations using the Horus Geo Suite
+
+    Instances do not share state, several databases can be matched
+    concurrently. Open and use an instance from a single thread, the
+    sqlite connection is bound to the thread that opened it.
     """
 
     class Field_info(NamedTuple):
@@ -28,13 +35,15 @@ class Spatialite:
         name: str
         type: str
 
-    recordings = {}
-    blob_containing_geometry = {}
+    recordings: {str: str}
+    blob_containing_geometry: {str: bool}
     recording_field_name: str = None
     frame_index_field_name: str = None
     geometry_field_name = "the_geom"
     table_name: str
     field_info_map: {str, Field_info} = None
+    field_info_maps: {str: {str, Field_info}}
+    spatial_index_map: {(str, str): bool}
 
     FIELD_INFO_IDX = 0
     FIELD_INFO_NAME = 1
@@ -44,16 +53,24 @@ class Spatialite:
 
     # --- Remote Database
     RD_connection = None
-    spatialite_RD_recording_map = {}
+    spatialite_RD_recording_map: {str: Recording}
 
     # ------ Recordings On Disk  ------
-    ROD_frame_location_guids = []
+    ROD_frame_location_guids: [str]
     ROD_recordings_root_folder: str = None
-    spatialite_ROD_recording_map = {}
+    spatialite_ROD_recording_map: {str: str}
 
     def __init__(self, filename):
         self.filename = filename
         self.table_name = self.__table_name_from_file__()
+        # Per instance state, databases can be processed concurrently
+        self.recordings = {}
+        self.blob_containing_geometry = {}
+        self.field_info_maps = {}
+        self.spatial_index_map = {}
+        self.spatialite_RD_recording_map = {}
+        self.ROD_frame_location_guids = []
+        self.spatialite_ROD_recording_map = {}
 
     def set_recordings_on_disk_root_folder(self, path):
         self.ROD_recordings_root_folder = path
@@ -90,6 +107,7 @@ class Spatialite:
 
     def set_table_name(self, name):
         self.table_name = name
+        self.field_info_map = self.field_info_maps.get(name)
 
     def get_field_query(self, cursor):
         cursor.execute(
@@ -120,8 +138,9 @@ class Spatialite:
         self.blob_containing_geometry[field_name] = True
 
     def get_field_names_map(self, cursor=None) -> {str: Field_info}:
-        if not self.field_info_map is None:
-            return self.field_info_map
+        """Returns the fields of the table, the table info is queried once per table"""
+        if self.table_name in self.field_info_maps:
+            return self.field_info_maps[self.table_name]
 
         cleanup, cursor = self.check_cursor(cursor)
         self.get_table_info_query(cursor)
@@ -141,16 +160,74 @@ class Spatialite:
         if cleanup:
             cursor.close()
 
+        self.field_info_maps[self.table_name] = data
         return data
 
-    def query(self, cursor=None, field_names_map=None, order_by_list=[]):
+    def has_spatial_index(self, field_name, cursor=None):
+        """Returns True if the R*Tree 'idx_<table>_<field>' of a geometry field exists"""
+        key = (self.table_name, field_name)
+        if key not in self.spatial_index_map:
+            cleanup, cursor = self.check_cursor(cursor)
+            cursor.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'table' AND name = ?;",
+                (self.spatial_index_name(field_name),),
+            )
+            self.spatial_index_map[key] = cursor.fetchone() is not None
+            if cleanup:
+                cursor.close()
+
+        return self.spatial_index_map[key]
+
+    def spatial_index_name(self, field_name):
+        return "idx_" + self.table_name + "_" + field_name
+
+    def bbox_clause(self, bbox, field_names_map, cursor):
+        """Returns the where clause and parameters selecting the rows of which the
+        geometry field bounding box intersects bbox (xmin, ymin, xmax, ymax).
+
+        The spatial index is used when present, otherwise the rows are filtered
+        on their minimum bounding rectangle.
+        """
+        xmin, ymin, xmax, ymax = bbox
+        field = field_names_map[self.geometry_field_name]
+
+        if field.type == self.FIELD_NAME_GEOM and self.has_spatial_index(
+            field.name, cursor
+        ):
+            clause = (
+                'rowid IN (SELECT pkid FROM "'
+                + self.spatial_index_name(field.name)
+                + '" WHERE xmin <= ? AND xmax >= ? AND ymin <= ? AND ymax >= ?)'
+            )
+            return clause, [xmax, xmin, ymax, ymin]
+
+        geometry = field.name
+        if field.type == self.FIELD_NAME_BLOB:
+            geometry = "GeomFromWKB(" + field.name + ")"
+
+        clause = "MbrIntersects(" + geometry + ", BuildMbr(?, ?, ?, ?)) = 1"
+        return clause, [xmin, ymin, xmax, ymax]
+
+    def query(
+        self,
+        cursor=None,
+        field_names_map=None,
+        order_by_list=[],
+        bbox=None,
+        where=None,
+        limit=None,
+    ):
+        """Query the rows of the table
+
+        bbox:   (xmin, ymin, xmax, ymax) only rows of which the geometry intersects
+                the bounding box, uses the spatial index when available
+        where:  additional sql condition
+        limit:  maximum number of rows
+        """
         cleanup, cursor = self.check_cursor(cursor)
 
         if field_names_map is None:
-            if self.field_info_map is None:
-                field_info_map = self.get_field_names_map(cursor)
-            else:
-                field_names_map = self.field_info_map
+            field_names_map = self.get_field_names_map(cursor)
 
         fields = []
         for k, field in field_names_map.items():
@@ -163,13 +240,27 @@ class Spatialite:
 
         query_ = "SELECT " + myselect + ' FROM "' + self.table_name + '"'
 
-        add = " "
-        for x in order_by_list:
-            query_ += add + "ORDER BY " + x + " ASC"
-            add = ","
+        where_clause = []
+        params = []
+        if bbox is not None:
+            clause, bbox_params = self.bbox_clause(bbox, field_names_map, cursor)
+            where_clause.append(clause)
+            params += bbox_params
+        if where is not None:
+            where_clause.append("(" + where + ")")
+
+        if len(where_clause) > 0:
+            query_ += " WHERE " + " AND ".join(where_clause)
+
+        if len(order_by_list) > 0:
+            query_ += " ORDER BY " + ", ".join(x + " ASC" for x in order_by_list)
+
+        if limit is not None:
+            query_ += " LIMIT ?"
+            params.append(limit)
 
         query_ += ";"
-        cursor.execute(query_)
+        cursor.execute(query_, params)
         return cursor
 
     def get_geometry(self, cursor, field_names_map=None):
@@ -186,13 +277,40 @@ class Spatialite:
                         geoms[k] = wkb.loads(cursor[field.idx])
         return geoms
 
-    def get_matched_frames_iterator(self):
+    def get_matched_frames_iterator(self, bbox=None, where=None):
+        """Returns a FrameMatchedIterator
+
+        Optionally only the rows within bbox (xmin, ymin, xmax, ymax) and/or
+        matching the sql condition 'where' are iterated.
+        """
+        return FrameMatchedIterator(
+            self.matched_frames_query(bbox, where), self.RD_connection, self
+        )
+
+    def get_pipelined_matched_frames_iterator(
+        self, pool, workers=4, chunk_size=64, prefetch=4, bbox=None, where=None
+    ):
+        """Returns a PipelinedFrameMatchedIterator
+
+        The frames are resolved concurrently over connections of 'pool'.
+        """
+        return PipelinedFrameMatchedIterator(
+            self.matched_frames_query(bbox, where),
+            self.RD_connection,
+            self,
+            pool,
+            workers,
+            chunk_size,
+            prefetch,
+        )
+
+    def matched_frames_query(self, bbox=None, where=None):
         cursor = self.get_cursor()
         orderby = []
         if self.recording_field_name in self.field_info_map:
             orderby.append(self.recording_field_name)
-        self.query(cursor, self.field_info_map, orderby)
-        return FrameMatchedIterator(cursor, self.RD_connection, self)
+        self.query(cursor, self.field_info_map, orderby, bbox, where)
+        return cursor
 
     def resolve(self):
         # obtain the fields with the table appended with rowid
@@ -343,8 +461,12 @@ class FrameMatchedIterator:
         spatialite_cursor = None
         frame: Frame = None
         recording: Recording = None
-        properties = {}
-        metadata = {}
+        properties: dict
+        metadata: dict
+
+        def __init__(self):
+            self.properties = {}
+            self.metadata = {}
 
         def dump(self):
             print("spatialite_cursor", self.spatialite_cursor)
@@ -365,7 +487,7 @@ class FrameMatchedIterator:
     frame_limit: int = 10
     current_recording: str = None
     static_recording: Recording = None
-    recordings_list: [str, Recording] = {}
+    recordings_list: {int: Recording}
 
     guids: [str] = None
 
@@ -383,6 +505,8 @@ class FrameMatchedIterator:
         self.frames = Frames(connection)
         self.recordings = Recordings(connection)
         self.select_frame = lambda geom, cursor: Frame(cursor)
+        self.recordings_list = {}
+        self.recordings_lock = threading.Lock()
 
         # Can we use the Recording field
         if spatialite_db.recording_field_name != None:
@@ -429,98 +553,137 @@ class FrameMatchedIterator:
         return self
 
     def __next__(self):
-        frame = next(self.cursor, None)
-
-        while frame != None:
-            # Build up the matched frame
-            f = self.MatchedFrame()
-
-            f.spatialite_cursor = frame
-
-            use_recording_field = self.use_recording_field
-            use_frame_index_field = self.use_frame_index_field
-            frame_guid = None
-            frame_index = None
-
-            if use_recording_field:
-                if frame[self.recording_field_idx] == None:
-                    use_recording_field = False
-                else:
-                    if frame[self.recording_field_idx] != self.current_recording:
-                        self.current_recording = frame[self.recording_field_idx]
-                        self.guids = self.spatialite_db.resolve_frames(
-                            self.current_recording
-                        )
-
-            if use_frame_index_field:
-                if frame[self.frame_index_field_idx] == None:
-                    use_frame_index_field = False
-                else:
-                    frame_index = int(frame[self.frame_index_field_idx])
-                    # Try to be more precise with GUID
-                    if self.guids != None and len(self.guids) >= frame_index:
-                        frame_guid = self.guids[int(frame[self.frame_index_field_idx])]
-
-            if frame_guid != None:
-                f.properties["guid"] = frame_guid
-
-            if frame_index != None:
-                f.properties["index"] = frame_index
-
-            # Allow static recordings set_static_recording_by_id(..)
-            if self.use_static_recording:
-                f.properties["recordingid"] = self.static_recording.id
-
-            elif not self.current_recording is None:
-                if not self.spatialite_db.spatialite_RD_recording_map is None:
-                    if (
+        row = next(self.cursor, None)
+        if row is None:
+            raise StopIteration
+        return self.resolve(self.prepare(row))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """Release the resources of the iterator, see PipelinedFrameMatchedIterator"""
+        pass
+
+    def prepare(self, row):
+        """Build up the matched frame from a spatialite row.
+
+        Only local information is used (the row, the recording field and
+        the frames.xml of recordings on disk); rows should be prepared in order.
+        """
+        f = self.MatchedFrame()
+        f.spatialite_cursor = row
+
+        use_recording_field = self.use_recording_field
+        use_frame_index_field = self.use_frame_index_field
+        frame_guid = None
+        frame_index = None
+
+        if use_recording_field:
+            if row[self.recording_field_idx] == None:
+                use_recording_field = False
+            else:
+                if row[self.recording_field_idx] != self.current_recording:
+                    self.current_recording = row[self.recording_field_idx]
+                    self.guids = self.spatialite_db.resolve_frames(
                         self.current_recording
-                        in self.spatialite_db.spatialite_RD_recording_map
-                    ):
-                        f.properties[
-                            "recordingid"
-                        ] = self.spatialite_db.spatialite_RD_recording_map[
-                            self.current_recording
-                        ].id
-
-            has_guid = "guid" in f.properties
-            has_frame_index = "index" in f.properties
-            has_recording_id = "recordingid" in f.properties
-
-            if (has_recording_id and has_frame_index) or has_guid:
-                cursor = self.frames.query(**f.properties)
-                f.frame = Frame(cursor)
+                    )
+
+        if use_frame_index_field:
+            if row[self.frame_index_field_idx] == None:
+                use_frame_index_field = False
             else:
-                geom = self.spatialite_db.get_geometry(frame)[
-                    self.spatialite_db.geometry_field_name
-                ]
-                cursor = self.frames.query(
-                    within=(*geom.centroid.coords, self.d_max),
-                    **f.properties,
-                    distance=(*geom.centroid.coords, "> %s", self.d_min),
-                    limit=self.frame_limit,
-                )
-                f.frame = self.select_frame(geom, cursor)
+                frame_index = int(row[self.frame_index_field_idx])
+                # Try to be more precise with GUID
+                if self.guids != None and len(self.guids) >= frame_index:
+                    frame_guid = self.guids[int(row[self.frame_index_field_idx])]
+
+        if frame_guid != None:
+            f.properties["guid"] = frame_guid
+
+        if frame_index != None:
+            f.properties["index"] = frame_index
+
+        # Allow static recordings set_static_recording_by_id(..)
+        if self.use_static_recording:
+            f.properties["recordingid"] = self.static_recording.id
+
+        elif not self.current_recording is None:
+            if not self.spatialite_db.spatialite_RD_recording_map is None:
+                if (
+                    self.current_recording
+                    in self.spatialite_db.spatialite_RD_recording_map
+                ):
+                    f.properties[
+                        "recordingid"
+                    ] = self.spatialite_db.spatialite_RD_recording_map[
+                        self.current_recording
+                    ].id
 
-            if f.frame == None:
-                return f
+        return f
 
-            if not f.frame.recordingid in self.recordings_list:
-                temp_rec = next(
-                    Recording.query(self.recordings, id=f.frame.recordingid)
-                )
-                self.recordings.get_setup(temp_rec)
-                self.recordings_list[f.frame.recordingid] = temp_rec
+    def resolve(self, f, connection=None):
+        """Resolve the frame, recording and metadata of a prepared matched frame.
 
-            f.recording = self.recordings_list[f.frame.recordingid]
+        The remote database is queried through 'connection', by default the
+        connection of the iterator.
+        """
+        if connection is None:
+            connection = self.connection
+            frames = self.frames
+        else:
+            frames = Frames(connection)
 
-            self.add_metadata_from_remote_db(f, {"file", "path"})
+        has_guid = "guid" in f.properties
+        has_frame_index = "index" in f.properties
+        has_recording_id = "recordingid" in f.properties
 
-            return f
+        if (has_recording_id and has_frame_index) or has_guid:
+            cursor = frames.query(**f.properties)
+            f.frame = Frame(cursor)
         else:
-            raise StopIteration
+            geom = self.spatialite_db.get_geometry(f.spatialite_cursor)[
+                self.spatialite_db.geometry_field_name
+            ]
+            cursor = frames.query(
+                within=(*geom.centroid.coords, self.d_max),
+                **f.properties,
+                distance=(*geom.centroid.coords, "> %s", self.d_min),
+                limit=self.frame_limit,
+            )
+            f.frame = self.select_frame(geom, cursor)
+
+        if f.frame == None:
+            return f
+
+        f.recording = self.get_recording(f.frame.recordingid, connection)
+
+        self.add_metadata_from_remote_db(f, {"file", "path"}, connection)
+
+        return f
+
+    def get_recording(self, recording_id, connection):
+        """The (cached) recording, the remote database is queried outside the
+        lock; when threads race for the same recording the first one is kept.
+        """
+        with self.recordings_lock:
+            if recording_id in self.recordings_list:
+                return self.recordings_list[recording_id]
+
+        recordings = Recordings(connection)
+        temp_rec = next(Recording.query(recordings, id=recording_id))
+        recordings.get_setup(temp_rec)
+
+        with self.recordings_lock:
+            return self.recordings_list.setdefault(recording_id, temp_rec)
+
+    def add_metadata_from_remote_db(self, f, keys, connection=None):
+        if connection is None:
+            connection = self.connection
 
-    def add_metadata_from_remote_db(self, f, keys):
         iie_query = (
             "select * from frames,image_index_entries where image_index_entries.frame_id = "
             + str(f.frame.id)
@@ -528,7 +691,7 @@ class FrameMatchedIterator:
             + str(f.recording.id)
         )
 
-        __cursor__ = self.connection.cursor()
+        __cursor__ = connection.cursor()
         __cursor__.execute(iie_query)
 
         values = __cursor__.fetchone()
@@ -538,3 +701,75 @@ class FrameMatchedIterator:
         for k in keys:
             if k in row:
                 f.metadata["image_index_entries." + k] = row[k]
+
+
+class PipelinedFrameMatchedIterator(FrameMatchedIterator):
+    """FrameMatchedIterator that resolves frames ahead of the consumer.
+
+    Spatialite rows are read in chunks and prepared in order, the frames of
+    a chunk are resolved concurrently by a small thread pool, each worker
+    borrowing a connection from 'pool' (e.g. psycopg2.pool.ThreadedConnectionPool).
+    MatchedFrames are yielded in row order; at most 'prefetch' chunks are in
+    flight, so the consumer (e.g. snapshot rendering) overlaps the matching
+    without unbounded memory use.
+
+    The workers are stopped when the iterator is exhausted; use it as a
+    context manager, or call close(), when the consumer may stop early.
+    """
+
+    def __init__(
+        self,
+        cursor,
+        connection,
+        spatialite_db: Spatialite,
+        pool,
+        workers: int = 4,
+        chunk_size: int = 64,
+        prefetch: int = 4,
+    ):
+        super().__init__(cursor, connection, spatialite_db)
+        self.pool = pool
+        self.chunk_size = chunk_size
+        self.prefetch = prefetch
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.pending = deque()
+        self.exhausted = False
+
+    def __next__(self):
+        if len(self.pending) <= (self.prefetch - 1) * self.chunk_size:
+            self.fill()
+
+        if len(self.pending) == 0:
+            self.close()
+            raise StopIteration
+
+        return self.pending.popleft().result()
+
+    def fill(self):
+        """Read, prepare and submit chunks until 'prefetch' chunks are pending"""
+        while (
+            not self.exhausted and len(self.pending) < self.prefetch * self.chunk_size
+        ):
+            rows = self.cursor.fetchmany(self.chunk_size)
+            if len(rows) < self.chunk_size:
+                self.exhausted = True
+
+            for row in rows:
+                self.pending.append(
+                    self.executor.submit(self.resolve_pooled, self.prepare(row))
+                )
+
+    def resolve_pooled(self, f):
+        connection = self.pool.getconn()
+        try:
+            return self.resolve(f, connection)
+        finally:
+            self.pool.putconn(connection)
+
+    def close(self):
+        """Cancel the frames that are not yet resolved and stop the workers"""
+        self.exhausted = True
+        for future in self.pending:
+            future.cancel()
+        self.pending.clear()
+        self.executor.shutdown(wait=True)
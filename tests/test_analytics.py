@@ -0,0 +1,321 @@
+# Copyright(C) 2022 Horus View and Explore B.V.
+
+import unittest
+
+import numpy as np
+import geopandas as gpd
+from shapely.geometry import Point
+import pymap3d
+
+from horus_gis import SchemaProvider, PositionVector, Geographic
+from horus_geopandas import HorusGeoDataFrame
+from pyproj import Geod
+from horus_analytics import (
+    Clustering_analysis,
+    Metric,
+    cluster_measurements,
+    cluster_points,
+    cluster_position_vectors,
+    distance,
+    frame_window_pairs,
+    pairwise_distance,
+    haversine,
+)
+
+
+def create_analysis():
+    """Two clusters of measurements around Rotterdam"""
+    sp = SchemaProvider()
+    analysis = Clustering_analysis()
+
+    analysis.cluster_layer = HorusGeoDataFrame(
+        sp.merge(sp.single_measurement(), sp.clustering())
+    )
+    analysis.cluster_layer.add_records(
+        {
+            "geometry": [
+                Point(4.4818, 51.9124, 0.0),
+                Point(4.4819, 51.9125, 0.0),
+                Point(4.4900, 51.9200, 0.0),
+                Point(4.4817, 51.9123, 0.0),
+            ],
+            "usr_id": [0, 1, 2, 3],
+            "azimuth": [10.0, 20.0, 30.0, 40.0],
+            "dt_yaw": [15.0, 15.0, 90.0, 35.0],
+            "dt_conf": [0.5, 0.7, 0.9, 0.6],
+            "rec_id": [1, 1, 2, 1],
+            "frame_idx": [4, 5, 1, 7],
+            "clstr_id": [1, 1, 2, 1],
+        },
+        validate=False,
+    )
+
+    analysis.cluster_location_layer = HorusGeoDataFrame(
+        sp.merge(sp.geometry_3dpoint(), sp.clustering())
+    )
+    analysis.cluster_location_layer.add_records(
+        {
+            "geometry": [Point(4.4901, 51.9201, 1.0), Point(4.4818, 51.9124, 1.0)],
+            "clstr_id": [2, 1],
+            "clstr_conf": [0.7, 0.7],
+        }
+    )
+    return analysis
+
+
+class TestDistance(unittest.TestCase):
+    def test_distance(self):
+        lon = np.array([4.4818, 4.4900, 5.0])
+        lat = np.array([51.9124, 51.9200, 52.0])
+
+        geodesic = distance(lon, lat, 4.4818, 51.9124, Metric.GEODESIC)
+        expected = Geod(ellps="WGS84").inv(
+            lon, lat, np.full(3, 4.4818), np.full(3, 51.9124)
+        )[2]
+        np.testing.assert_allclose(geodesic, expected)
+
+        # one degree of latitude on the mean sphere
+        self.assertAlmostEqual(distance(0, 0, 0, 1), 111195.08, places=2)
+
+        # haversine and geodesic agree within half a percent
+        haversine_m = distance(lon, lat, 4.4818, 51.9124)
+        np.testing.assert_allclose(haversine_m, geodesic, rtol=5e-3, atol=1e-6)
+
+    def test_pairwise_distance(self):
+        lon1, lat1 = [4.4818, 4.4900], [51.9124, 51.9200]
+        lon2, lat2 = [4.4818, 5.0, 6.0], [51.9124, 52.0, 53.0]
+        for metric in Metric:
+            matrix = pairwise_distance(lon1, lat1, lon2, lat2, metric)
+            self.assertEqual(matrix.shape, (2, 3))
+            for i in range(2):
+                for j in range(3):
+                    self.assertAlmostEqual(
+                        matrix[i, j],
+                        distance(lon1[i], lat1[i], lon2[j], lat2[j], metric),
+                    )
+
+
+class TestClustering(unittest.TestCase):
+    def test_cluster_points(self):
+        # two groups 1 meter apart, one point of another class, one isolated point
+        lat_m = 1.0 / 111195.08
+        lon = np.array([4.48, 4.48, 4.48, 4.48, 4.50])
+        lat = 51.91 + np.array([0.0, 5.0, 1.0, 6.0, 0.0]) * lat_m
+        classes = np.array([1, 1, 1, 2, 1])
+
+        clstr_id, clstr_conf = cluster_points(lon, lat, 3.0)
+        np.testing.assert_array_equal(clstr_id, [1, 2, 1, 2, 3])
+
+        clstr_id, clstr_conf = cluster_points(lon, lat, 3.0, classes)
+        np.testing.assert_array_equal(clstr_id, [1, 2, 1, 3, 4])
+        np.testing.assert_array_equal(clstr_conf, [1.0, 1.0, 1.0, 1.0, 1.0])
+
+        # chain: 0 - 1 - 2, with 0 and 2 not within the radius
+        clstr_id, clstr_conf = cluster_points(lon[:3], lat[:3], 4.5)
+        np.testing.assert_array_equal(clstr_id, [1, 1, 1])
+        np.testing.assert_allclose(clstr_conf, [2 / 3, 2 / 3, 1.0])
+
+    def test_cluster_points_brute_force(self):
+        rng = np.random.default_rng(7)
+        lon = 4.48 + rng.uniform(0, 0.001, 300)
+        lat = 51.91 + rng.uniform(0, 0.001, 300)
+        clstr_id, _ = cluster_points(lon, lat, 3.0)
+
+        within = pairwise_distance(lon, lat, lon, lat) <= 3.0
+        for i, j in zip(*np.nonzero(within)):
+            self.assertEqual(clstr_id[i], clstr_id[j])
+        # every cluster is connected
+        for cid in np.unique(clstr_id):
+            members = np.flatnonzero(clstr_id == cid)
+            reached = {members[0]}
+            frontier = [members[0]]
+            while frontier:
+                i = frontier.pop()
+                for j in np.flatnonzero(within[i]):
+                    if j not in reached:
+                        reached.add(j)
+                        frontier.append(j)
+            self.assertEqual(reached, set(members))
+
+    def test_frame_window_pairs(self):
+        rng = np.random.default_rng(3)
+        rec_id = rng.integers(0, 3, 200)
+        frame_idx = rng.integers(0, 40, 200)
+        pairs = frame_window_pairs(rec_id, frame_idx, 2)
+
+        expected = {
+            (i, j)
+            for i in range(200)
+            for j in range(200)
+            if rec_id[i] == rec_id[j] and 0 < frame_idx[j] - frame_idx[i] <= 2
+        }
+        found = {(i, j) if frame_idx[i] < frame_idx[j] else (j, i) for i, j in pairs}
+        self.assertEqual(len(pairs), len(expected))
+        self.assertEqual(found, expected)
+
+    def test_cluster_measurements_frame_window(self):
+        # camera driving north, east/north offsets in meters
+        lat_m = 1.0 / 111195.08
+        lon_m = lat_m / np.cos(np.radians(51.91))
+
+        def measurement(frame, camera_north, east, north):
+            return {
+                "geometry": Point(4.48 + east * lon_m, 51.91 + north * lat_m),
+                "rec_id": 1,
+                "frame_idx": frame,
+                "cam_lon": 4.48,
+                "cam_lat": 51.91 + camera_north * lat_m,
+                "dt_yaw": np.degrees(np.arctan2(east, north - camera_north)),
+                "dt_class": 1,
+            }
+
+        dataframe = gpd.GeoDataFrame(
+            [
+                # object A seen from frame 1 and 2, object C next to it
+                measurement(1, 0, 5, 20),
+                measurement(1, 0, 3, 20),
+                measurement(2, 2, 5, 20),
+                measurement(2, 2, 3, 20),
+                # object B, 2 meter from A, seen from frame 10 and 11
+                measurement(10, 18, 5, 22),
+                measurement(11, 20, 5, 22),
+            ]
+        )
+
+        clstr_id, _ = cluster_measurements(dataframe, radius=3.0)
+        np.testing.assert_array_equal(clstr_id, [1, 1, 1, 1, 1, 1])
+
+        clstr_id, clstr_conf = cluster_measurements(
+            dataframe, radius=3.0, frame_window=3, ray_tolerance=1.0
+        )
+        np.testing.assert_array_equal(clstr_id, [1, 2, 1, 2, 3, 3])
+        np.testing.assert_array_equal(clstr_conf, np.ones(6))
+
+    def test_cluster_position_vectors(self):
+        # a sign 3 meters above the road and a pole across the road
+        objects = [(51.91020, 4.48010, 48.0), (51.91022, 4.47992, 45.0)]
+        cameras = [(51.91000 + i * 0.00002, 4.48000, 45.0) for i in range(3)]
+
+        pos_vectors = []
+        for location in objects:
+            for camera in cameras:
+                yaw, pitch, _ = pymap3d.geodetic2aer(*location, *camera)
+                pos_vectors.append(PositionVector(*camera, yaw, pitch))
+
+        clstr_id, clstr_conf, locations = cluster_position_vectors(pos_vectors)
+        np.testing.assert_array_equal(clstr_id, [1, 1, 1, 2, 2, 2])
+        np.testing.assert_array_equal(clstr_conf, np.ones(6))
+        np.testing.assert_allclose(
+            locations[:, :2], np.array(objects)[:, :2], atol=1e-8
+        )
+        np.testing.assert_allclose(locations[:, 2], np.array(objects)[:, 2], atol=1e-3)
+        np.testing.assert_allclose(
+            locations[0], Geographic.triangulate(pos_vectors[:3]), atol=1e-8
+        )
+
+
+class TestClusteringAnalysis(unittest.TestCase):
+    def test_analyse_cluster_entries(self):
+        analysis = create_analysis()
+        analysis.analyse_cluster_entries()
+        entries = analysis.layers["cluster_entries_analysis"].dataframe
+
+        # grouped per cluster location, in location order
+        self.assertEqual(entries["usr_id"].tolist(), [2, 0, 1, 3])
+        self.assertEqual(entries["angle"].tolist(), [60.0, 5.0, -5.0, -5.0])
+
+        locations = {2: Point(4.4901, 51.9201), 1: Point(4.4818, 51.9124)}
+        data = analysis.cluster_layer.dataframe.set_index("usr_id")
+        expected = [
+            int(haversine(locations[data.at[i, "clstr_id"]], data.at[i, "geometry"]))
+            for i in entries["usr_id"]
+        ]
+        np.testing.assert_array_equal(entries["distance"].to_numpy(), expected)
+
+    def test_analyse_cluster_entries_truncated(self):
+        analysis = create_analysis()
+        analysis.cluster_layer.add_records(
+            {
+                "geometry": [Point(4.4818, 51.91246, 0.0)],
+                "usr_id": [4],
+                "azimuth": [10.0],
+                "dt_yaw": [15.0],
+                "dt_conf": [0.5],
+                "rec_id": [1],
+                "frame_idx": [8],
+                "clstr_id": [1],
+            },
+            validate=False,
+        )
+        analysis.analyse_cluster_entries()
+        entries = analysis.layers["cluster_entries_analysis"].dataframe
+
+        # 6.67 meter, the distance is truncated to whole meters
+        distance = entries.set_index("usr_id").at[4, "distance"]
+        self.assertAlmostEqual(
+            haversine(Point(4.4818, 51.9124), Point(4.4818, 51.91246)), 6.67, places=2
+        )
+        self.assertEqual(distance, 6)
+
+    def test_analyse_cluster(self):
+        analysis = create_analysis()
+        analysis.analyse_cluster()
+        clusters = analysis.layers["cluster_analysis"].dataframe
+
+        self.assertEqual(clusters["clstr_id"].tolist(), [2, 1])
+        self.assertEqual(clusters["clstr_pts"].tolist(), [1, 3])
+        self.assertEqual(clusters["frm_span"].tolist(), [0, 3])
+        np.testing.assert_allclose(clusters["mean_conf"], [0.9, 0.6])
+
+        centroid = clusters.geometry.iloc[1]
+        self.assertAlmostEqual(centroid.x, 4.4818)
+        self.assertAlmostEqual(centroid.y, 51.9124)
+        self.assertEqual(clusters["clstr_rms"].iloc[0], 0.0)
+        points = [
+            Point(4.4818, 51.9124),
+            Point(4.4819, 51.9125),
+            Point(4.4817, 51.9123),
+        ]
+        rms = np.sqrt(np.mean([haversine(centroid, p) ** 2 for p in points]))
+        self.assertAlmostEqual(clusters["clstr_rms"].iloc[1], rms)
+
+    def test_analyse_cluster_recordings(self):
+        analysis = create_analysis()
+        analysis.cluster_layer.add_records(
+            {
+                "geometry": [Point(4.4818, 51.9124, 0.0), Point(4.4818, 51.9124, 0.0)],
+                "usr_id": [4, 5],
+                "azimuth": [10.0, 10.0],
+                "dt_yaw": [15.0, 15.0],
+                "dt_conf": [0.5, 0.5],
+                "rec_id": [3, 3],
+                "frame_idx": [100, 102],
+                "clstr_id": [1, 1],
+            },
+            validate=False,
+        )
+        analysis.analyse_cluster()
+        clusters = analysis.layers["cluster_analysis"].dataframe
+
+        # the span of recording 1, not the frames 4 to 102 of recordings 1 and 3
+        self.assertEqual(clusters["clstr_pts"].tolist(), [1, 5])
+        self.assertEqual(clusters["frm_span"].tolist(), [0, 3])
+
+    def test_analyse_cluster_without_entries(self):
+        analysis = create_analysis()
+        analysis.cluster_location_layer.add_records(
+            {
+                "geometry": [Point(4.4950, 51.9250, 2.0)],
+                "clstr_id": [7],
+                "clstr_conf": [0.1],
+            }
+        )
+        analysis.analyse_cluster()
+        clusters = analysis.layers["cluster_analysis"].dataframe
+
+        self.assertEqual(clusters["clstr_id"].tolist(), [2, 1, 7])
+        self.assertEqual(clusters["clstr_pts"].tolist(), [1, 3, 0])
+        self.assertEqual(clusters["frm_span"].tolist(), [0, 3, 0])
+        self.assertEqual(clusters["clstr_rms"].iloc[2], 0.0)
+        self.assertEqual(clusters["mean_conf"].iloc[2], 0.0)
+        self.assertEqual(clusters.geometry.iloc[2], Point(4.4950, 51.9250, 2.0))
@@ -0,0 +1,111 @@
+# Copyright(C) 2023 Horus View and Explore B.V.
+
+import unittest
+import math
+
+import numpy
+
+from horus_camera import SphericalCamera
+from horus_gis import CameraModel, GeographicLocation
+from horus_media import Size
+
+
+class Frame:
+    recordingid = 1
+    uuid = "1708a7fb-af45-41b2-a0c1-1b9962f58ac0"
+    heading = 30.0
+    index = 0
+
+    def get_location(self):
+        return (4.4800, 51.9100, 45.0)
+
+
+class Image:
+    def get_resolution(self):
+        return Size(1024, 600)
+
+    def get_field_of_view(self):
+        return 90.0
+
+
+class TestSphericalCamera(unittest.TestCase):
+    def __init__(self, *args, **kwargs):
+        super(TestSphericalCamera, self).__init__(*args, **kwargs)
+        self.camera = SphericalCamera()
+        self.camera.frame = Frame()
+        self.camera_model = CameraModel(Frame().get_location(), Frame.heading)
+
+    def project(self, request, location):
+        """Pixel of a location in the gnomonic view of the request"""
+        yaw = math.radians(request.direction.yaw + Frame.heading)
+        pitch = math.radians(request.direction.pitch)
+        center = numpy.array(
+            [
+                math.sin(yaw) * math.cos(pitch),
+                math.cos(yaw) * math.cos(pitch),
+                math.sin(pitch),
+            ]
+        )
+        right = numpy.cross(center, [0, 0, 1])
+        right /= numpy.linalg.norm(right)
+        up = numpy.cross(right, center)
+        focal = request.size.width / 2 / math.tan(math.radians(request.fov) / 2)
+
+        v = numpy.array(
+            self.camera_model.to_enu([location.lon, location.lat, location.alt])
+        )
+        return (
+            request.size.width / 2 + focal * (v @ right) / (v @ center),
+            request.size.height / 2 - focal * (v @ up) / (v @ center),
+        )
+
+    def test_region_request(self):
+        geo_locations = [
+            GeographicLocation(4.48010, 51.91020, 43.0),
+            GeographicLocation(4.48016, 51.91020, 43.0),
+            GeographicLocation(4.48016, 51.91024, 46.0),
+            GeographicLocation(4.48010, 51.91024, 46.0),
+        ]
+        request = self.camera.region_request(Image(), self.camera_model, geo_locations)
+
+        # the pixel density of the image
+        focal = request.size.width / 2 / math.tan(math.radians(request.fov) / 2)
+        self.assertAlmostEqual(focal, 512.0)
+
+        pixels = numpy.array([self.project(request, p) for p in geo_locations])
+        self.assertTrue((pixels >= -1e-6).all())
+        self.assertTrue((pixels <= [request.size.width, request.size.height]).all())
+        # the view is tight around the geometry
+        self.assertTrue((pixels.min(axis=0) < 1).all())
+        self.assertTrue(
+            (
+                pixels.max(axis=0) > [request.size.width - 1, request.size.height - 1]
+            ).all()
+        )
+
+    def test_region_request_degenerate(self):
+        lon, lat, alt = Frame().get_location()
+        d = 0.00001
+
+        # centered straight below the camera
+        below = [
+            GeographicLocation(lon - d, lat - d, alt - 3.0),
+            GeographicLocation(lon + d, lat - d, alt - 3.0),
+            GeographicLocation(lon + d, lat + d, alt - 3.0),
+            GeographicLocation(lon - d, lat + d, alt - 3.0),
+        ]
+        self.assertIsNone(self.camera.region_request(Image(), self.camera_model, below))
+
+        # all around the camera
+        around = [
+            GeographicLocation(lon - 10 * d, lat, alt),
+            GeographicLocation(lon, lat + 10 * d, alt),
+            GeographicLocation(lon + 10 * d, lat, alt),
+        ]
+        self.assertIsNone(
+            self.camera.region_request(Image(), self.camera_model, around)
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
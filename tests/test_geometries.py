@@ -0,0 +1,210 @@
+# Copyright(C) 2022 Horus View and Explore B.V.
+
+import unittest
+from unittest import mock
+
+import math
+import numpy
+import shapely
+from shapely.geometry import (
+    Point,
+    LineString,
+    Polygon,
+    MultiPolygon,
+    MultiLineString,
+    MultiPoint,
+    GeometryCollection,
+)
+
+from horus_gis import EnuModel
+from horus_geometries import Geometry_proj, TransformerEnuModel, EnuTiling, GEOD
+
+
+class TestGeometryProj(unittest.TestCase):
+    def __init__(self, *args, **kwargs):
+        super(TestGeometryProj, self).__init__(*args, **kwargs)
+        self.gp = Geometry_proj()
+        self.polygon = Polygon(
+            [(4.48, 51.91, 1), (4.481, 51.91, 1), (4.481, 51.911, 2), (4.48, 51.911, 1)]
+        )
+        self.parcel = Polygon(
+            [(4.49, 51.91, 0), (4.491, 51.91, 0), (4.491, 51.911, 0)],
+            [[(4.4905, 51.9102, 0), (4.4907, 51.9102, 0), (4.4907, 51.9104, 0)]],
+        )
+        self.linestring = LineString(
+            [(4.48, 51.91, 1), (4.4805, 51.9102, 1), (4.481, 51.911, 2)]
+        )
+
+    def assertRoundTrip(self, geometry):
+        projection = self.gp.to_enu(geometry)
+        self.assertTrue(projection.is_enu)
+        self.assertEqual(projection.geometry.geom_type, geometry.geom_type)
+
+        result = self.gp.to_geodetic(projection.geometry, projection)
+        self.assertFalse(result.is_enu)
+        self.assertTrue(
+            numpy.allclose(
+                shapely.get_coordinates(result.geometry, include_z=True),
+                shapely.get_coordinates(geometry, include_z=True),
+                atol=1e-8,
+            )
+        )
+
+    def test_to_enu(self):
+        projection = self.gp.to_enu(self.polygon)
+        coords = shapely.get_coordinates(projection.geometry, include_z=True)
+        self.assertTrue(numpy.allclose(coords[0], (0, 0, 0)))
+        # 0.001 degree longitude at 51.91 north
+        self.assertAlmostEqual(coords[1][0], 68.8, 1)
+        # same as the per vertex conversion
+        for p, geodetic in zip(coords, self.polygon.exterior.coords):
+            self.assertTrue(numpy.allclose(p, projection.model.to_enu(geodetic)))
+
+    def test_transformer_enu_model(self):
+        origin = (4.485, 51.915, 10.0)
+        points = shapely.get_coordinates(self.polygon, include_z=True)
+        model = TransformerEnuModel(origin)
+        self.assertTrue(
+            numpy.allclose(
+                model.to_enu_array(points), EnuModel(origin).to_enu_array(points)
+            )
+        )
+        self.assertTrue(
+            numpy.allclose(model.to_geodetic_array(model.to_enu_array(points)), points)
+        )
+
+    def test_tile_projection(self):
+        a = self.gp.tile_projection(4.4812, 51.9105)
+        b = self.gp.tile_projection(4.4899, 51.9101)
+        c = self.gp.tile_projection(4.4912, 51.9105)
+        self.assertIs(a.model, b.model)
+        self.assertIsNot(a.model, c.model)
+        self.assertIsNot(a, b)
+        self.assertIs(a.geod, GEOD)
+        self.assertTrue(numpy.allclose(a.model.geodeticPoint, (4.485, 51.915, 0)))
+
+    def test_enu_tiling(self):
+        tiling = EnuTiling(0.01)
+        geometries = [self.polygon, self.parcel, self.linestring, Point(5.0, 52.0)]
+        enu, models = tiling.to_enu(geometries)
+        self.assertIs(models[0], models[2])
+        self.assertIsNot(models[0], models[1])
+        self.assertIsNot(models[0], models[3])
+        self.assertEqual(len(enu[1].interiors), 1)
+
+        result = tiling.to_geodetic(enu, models)
+        for geometry, geodetic in zip(geometries, result):
+            self.assertTrue(
+                numpy.allclose(
+                    shapely.get_coordinates(geodetic),
+                    shapely.get_coordinates(geometry),
+                    atol=1e-9,
+                )
+            )
+
+    def test_enu_tiling_error_bounds(self):
+        # documented scale error of 1e-1 degree tiles
+        tiling = EnuTiling(0.1)
+        corner = LineString([(0.0, 0.0, 0), (0.0001, 0.0001, 0)])
+        enu, _ = tiling.to_enu([corner])
+        geodesic = GEOD.inv(0.0, 0.0, 0.0001, 0.0001)[2]
+        self.assertLess(abs(enu[0].length - geodesic) / geodesic, 8e-7)
+
+    def test_round_trip(self):
+        for geometry in [
+            Point(4.48, 51.91, 1),
+            self.linestring,
+            self.polygon,
+            self.parcel,
+            MultiPolygon([self.polygon, self.parcel]),
+            GeometryCollection(
+                [self.parcel, self.linestring, MultiPoint([(4.48, 51.9, 0)])]
+            ),
+        ]:
+            self.assertRoundTrip(geometry)
+
+    def test_interiors(self):
+        projection = self.gp.to_enu(self.parcel)
+        self.assertEqual(len(projection.geometry.interiors), 1)
+        self.assertLess(projection.geometry.area, 0.5 * 68.8 * 111.2)
+
+    def test_split_linestring_equally(self):
+        linestring = LineString([(0, 0, 0), (3, 4, 0), (3, 10, 6), (3, 11, 8)])
+        pieces = Geometry_proj.split_linestring_equally(linestring, 5)
+
+        self.assertEqual(len(pieces), 3)
+        for piece in pieces:
+            self.assertAlmostEqual(piece.length, 4.0)
+        self.assertEqual(pieces[0].coords[:], [(0, 0, 0), (2.4, 3.2, 0)])
+        self.assertEqual(pieces[1].coords[:], [(2.4, 3.2, 0), (3, 4, 0), (3, 7, 3)])
+        self.assertEqual(pieces[2].coords[-1], (3, 11, 8))
+        self.assertEqual(
+            Geometry_proj.split_linestring_equally(LineString([(1, 1), (1, 1)]), 5), []
+        )
+
+    def test_split_linestring(self):
+        pieces = self.gp.split_linestring(self.linestring, 5)
+        lengths = [self.gp.create_projection(p).geod.geometry_length(p) for p in pieces]
+        self.assertEqual(len(pieces), math.ceil(sum(lengths) / 5))
+        self.assertTrue(numpy.allclose(lengths, lengths[0], rtol=1e-4))
+        self.assertLessEqual(lengths[0], 5.0)
+        self.assertTrue(numpy.allclose(pieces[0].coords[0], self.linestring.coords[0]))
+        self.assertTrue(
+            numpy.allclose(pieces[-1].coords[-1], self.linestring.coords[-1])
+        )
+
+    def test_look_at_polygons(self):
+        point = Point(4.4812, 51.9105, 3)
+        short = LineString([(5.48, 51.91, 1), (5.48001, 51.91001, 1)])
+        plan = self.gp.look_at_polygons(
+            [MultiLineString([self.linestring, short]), point, self.polygon]
+        )
+
+        pieces = self.gp.split_linestring(self.linestring, 5)
+        self.assertEqual(len(plan.polygon), len(pieces) + 3)
+        self.assertEqual(plan.source.tolist(), [0] * (len(pieces) + 1) + [1, 2])
+        self.assertEqual(plan.split.tolist(), [True] * len(pieces) + [False] * 3)
+
+        # the same as the per geometry functions
+        expected = [self.gp.buffer(p, 0.1) for p in pieces] + [
+            self.gp.buffer(short, 0.1),
+            self.gp.point_to_square(point, 0.5),
+            self.polygon,
+        ]
+        for polygon, result in zip(expected, plan.polygon):
+            self.assertEqual(result.geom_type, "Polygon")
+            self.assertTrue(result.has_z)
+            self.assertLess(
+                polygon.symmetric_difference(result).area / polygon.area, 1e-3
+            )
+
+    def test_look_at_polygons_nested(self):
+        point = Point(4.4812, 51.9105, 3)
+        nested = GeometryCollection(
+            [MultiPoint([point, Point(4.4813, 51.9106, 3)]), self.polygon]
+        )
+        plan = self.gp.look_at_polygons([self.polygon, nested])
+        self.assertEqual(plan.source.tolist(), [0, 1, 1, 1])
+        self.assertLess(
+            plan.polygon[1]
+            .symmetric_difference(self.gp.point_to_square(point, 0.5))
+            .area
+            / plan.polygon[1].area,
+            1e-3,
+        )
+        self.assertEqual(plan.polygon[3], self.polygon)
+
+        with mock.patch("builtins.print") as printed:
+            plan = self.gp.look_at_polygons([self.polygon.exterior, point])
+        self.assertEqual(plan.source.tolist(), [1])
+        printed.assert_called_once()
+
+    def test_buffer(self):
+        buffered = self.gp.buffer(self.linestring, 0.5)
+        self.assertEqual(buffered.geom_type, "Polygon")
+        self.assertTrue(buffered.has_z)
+        self.assertTrue(buffered.contains(Point(4.4805, 51.9102)))
+
+
+if __name__ == "__main__":
+    unittest.main()
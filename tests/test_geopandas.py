@@ -1,12 +1,16 @@
 # Copyright(C) 2022 Horus View and Explore B.V.
 
 import unittest
+from unittest import mock
 
 import os
 
 from horus_gis import SchemaProvider
-from horus_geopandas import HorusGeoDataFrame
+from horus_geopandas import HorusGeoDataFrame, Validation
+import horus_geopandas
 import geopandas as gpd
+import pandera as pa
+from shapely.geometry import Point
 
 # Create output directory
 output_dir = "./tests/data/"
@@ -110,3 +114,135 @@ class TestHorusGeoDataFrame(unittest.TestCase):
             os.path.join(output_dir, "single_measurement.gpkg"),
             layer="singlemeasurement",
         )
+
+    def test_add_records(self):
+        schema = self.schema.merge(
+            self.schema.geometry_3dpoint(), self.schema.clustering()
+        )
+        database = HorusGeoDataFrame(schema, batch_size=4)
+
+        for i in range(10):
+            database.add_record(geometry=Point(i, i, 0), clstr_id=i, clstr_conf=0.5)
+        self.assertEqual(len(database), 10)
+
+        database.add_records(
+            {
+                "geometry": gpd.points_from_xy([1, 2], [3, 4], [0, 0]),
+                "clstr_id": [10, 11],
+                "clstr_conf": [0.1, 0.2],
+            }
+        )
+
+        dataframe = database.dataframe
+        self.assertEqual(len(dataframe), 12)
+        self.assertEqual(list(dataframe.index), list(range(12)))
+        self.assertEqual(list(dataframe["clstr_id"]), list(range(12)))
+        self.assertEqual(dataframe["clstr_id"].dtype, "int64")
+
+        database.write_geopackage(
+            os.path.join(output_dir, "clusters.gpkg"), layer="clusters"
+        )
+
+    def test_add_records_fields(self):
+        schema = self.schema.merge(
+            self.schema.geometry_3dpoint(), self.schema.clustering()
+        )
+        database = HorusGeoDataFrame(schema)
+
+        database.add_records({})
+        self.assertEqual(len(database), 0)
+
+        with self.assertRaises(Exception):
+            database.add_record(geometry=Point(0, 0, 0), clstr_idd=1)
+        with self.assertRaises(Exception):
+            database.add_records({"geometry": [Point(0, 0, 0)], "clstr_idd": [1]})
+        self.assertEqual(len(database), 0)
+
+    def test_add_frame_coerce(self):
+        schema = self.schema.merge(
+            self.schema.geometry_3dpoint(), self.schema.clustering()
+        )
+        database = HorusGeoDataFrame(schema)
+        database.add_frame(
+            gpd.GeoDataFrame(
+                {"clstr_id": [1.0, 2.0], "clstr_conf": [0.5, 0.5]},
+                geometry=[Point(0, 0, 0), Point(1, 1, 0)],
+                crs=database.crs,
+            )
+        )
+        self.assertEqual(database.dataframe["clstr_id"].dtype, "int64")
+
+    def test_validation_on_write(self):
+        schema = self.schema.merge(
+            self.schema.geometry_3dpoint(), self.schema.clustering()
+        )
+        database = HorusGeoDataFrame(schema, validation=Validation.ON_WRITE)
+
+        for i in range(5):
+            clstr_id = "invalid" if i == 3 else i
+            database.add_record(
+                geometry=Point(i, i, 0), clstr_id=clstr_id, clstr_conf=0.5
+            )
+        self.assertEqual(len(database.dataframe), 5)
+
+        with self.assertRaises(pa.errors.SchemaErrors) as context:
+            database.write_geojson(os.path.join(output_dir, "invalid.geojson"))
+        failure_cases = context.exception.failure_cases
+        self.assertIn(3, list(failure_cases["index"]))
+
+    @unittest.skipUnless(horus_geopandas.pyarrow_found, "requires pyarrow")
+    def test_geoparquet(self):
+        schema = self.schema.merge(
+            self.schema.geometry_3dpoint(), self.schema.clustering()
+        )
+        database = HorusGeoDataFrame(schema)
+        for i in range(9):
+            database.add_record(geometry=Point(i, i, 1), clstr_id=i % 3, clstr_conf=0.5)
+
+        filename = os.path.join(output_dir, "clusters.parquet")
+        database.write_geoparquet(filename, partition_by="clstr_id")
+
+        result = HorusGeoDataFrame(schema)
+        result.append_geoparquet(filename, filters=[("clstr_id", "=", 1)])
+        dataframe = result.dataframe
+        self.assertEqual(len(dataframe), 3)
+        self.assertEqual(list(dataframe["clstr_id"]), [1, 1, 1])
+        self.assertEqual(dataframe.geometry.iloc[0], Point(1, 1, 1))
+
+        # rows without a partition value are written too
+        database.add_records(
+            {"geometry": [Point(9, 9, 1)], "clstr_id": [None], "clstr_conf": [0.5]},
+            validate=False,
+        )
+        database.write_geoparquet(filename, partition_by="clstr_id")
+        self.assertEqual(len(gpd.read_parquet(filename)), 10)
+
+    def test_iter_file(self):
+        schema = self.schema.merge(
+            self.schema.geometry_3dpoint(), self.schema.clustering()
+        )
+        database = HorusGeoDataFrame(schema)
+        for i in range(25):
+            database.add_record(geometry=Point(i, i, 1), clstr_id=i, clstr_conf=0.5)
+        filename = os.path.join(output_dir, "chunks.gpkg")
+        database.write_geopackage(filename, layer="chunks")
+
+        chunks = list(database.iter_file(filename, "chunks", chunk_size=10))
+        self.assertEqual([len(chunk) for chunk in chunks], [10, 10, 5])
+        self.assertEqual(list(chunks[2].index), list(range(20, 25)))
+        self.assertEqual(chunks[2]["clstr_id"].dtype, "int64")
+
+        chunks = database.iter_file(filename, "chunks", bbox=(2.5, 2.5, 9.5, 9.5))
+        self.assertEqual(sum(len(chunk) for chunk in chunks), 7)
+
+        # chunked appends follow the validation policy
+        for validation, calls in [(Validation.EAGER, 3), (Validation.ON_WRITE, 0)]:
+            result = HorusGeoDataFrame(schema, validation=validation)
+            with mock.patch.object(
+                result.non_geom_schema,
+                "validate",
+                wraps=result.non_geom_schema.validate,
+            ) as validate:
+                result.append_file(filename, "chunks", chunk_size=10)
+                self.assertEqual(validate.call_count, calls)
+            self.assertEqual(len(result.dataframe), 25)
@@ -2,6 +2,10 @@
 
 import unittest
 import os
+import io
+
+import numpy
+from PIL import Image
 
 from horus_media import (
     Client,
@@ -11,6 +15,8 @@ from horus_media import (
     Scales,
     Rect,
     Mode,
+    Box,
+    Size,
 )
 
 path = "./tests/data/"
@@ -108,6 +114,118 @@ class TestGrid(unittest.TestCase):
         self.assertEqual(count, 10)
         self.assertEqual(len(result), 0)
 
+    def test_filter_fov(self):
+        grid = Grid()
+        fov = Box.create((-85.5, 0), 169, 88)
+        sections = [section.index for section in grid.filter(fov)]
+        self.assertEqual(sections, [8, 9, 10, 11, 16, 17, 18, 19])
+        # the same (cached) result
+        sections = [section.index for section in grid.filter(fov)]
+        self.assertEqual(sections, [8, 9, 10, 11, 16, 17, 18, 19])
+
+    def test_filter_boundaries(self):
+        grid = Grid(r=2, c=4)
+        # open interval, sections only touching the boundaries are excluded
+        sections = grid.filter(w_min=-90, w_max=0, h_min=0, h_max=90)
+        self.assertEqual([section.index for section in sections], [1])
+        sections = grid.filter(w_min=90, w_max=270, h_min=-90, h_max=90)
+        self.assertEqual([section.index for section in sections], [0, 3, 4, 7])
+
+
+class SectionResult:
+    """A fetched section, generated locally"""
+
+    def __init__(self, section, color, size, mode="RGB"):
+        self.section = section
+        self.url = f"local://{section.index}"
+        self.color = color
+        image = io.BytesIO()
+        Image.new(mode, (size, size), color).save(image, format="jpeg")
+        self.data = image.getvalue()
+
+    def result(self):
+        return self.data
+
+
+class TestImageProvider(unittest.TestCase):
+    def test_combine(self):
+        grid = Grid()
+        provider = ImageProvider(grid)
+        sections = list(grid.filter(h_min=-44, h_max=44, w_min=-170, w_max=-1))
+        colors = {
+            section.index: (section.index * 10, 255 - section.index * 10, 128)
+            for section in sections
+        }
+        requests = [SectionResult(s, colors[s.index], 32) for s in sections]
+
+        result = provider.combine(requests, 32, 32, ImageProvider.Output.ARRAY)
+        self.assertEqual(result.image.shape, (64, 128, 3))
+        self.assertEqual((result.w, result.h), (128, 64))
+        self.assertEqual(result.fov, Rect(x=-180.0, y=-45.0, width=180.0, height=90.0))
+        for req in requests:
+            x, y = result.to_pixel_coordinates((req.section.ax, req.section.ay))
+            pixel = result.image[int(y) - 16, int(x) + 16]
+            self.assertTrue(numpy.allclose(pixel, colors[req.section.index], atol=3))
+
+        image = provider.combine(requests, 32, 32, ImageProvider.Output.IMAGE).image
+        self.assertEqual(image.size, (128, 64))
+        self.assertTrue(numpy.array_equal(numpy.asarray(image), result.image))
+
+        encoded = provider.combine(requests, 32, 32)
+        self.assertIsInstance(encoded.image, io.BytesIO)
+        self.assertEqual(ImageProvider.encode(result).image.getvalue()[:2], b"\xff\xd8")
+        with Image.open(encoded.image) as decoded:
+            self.assertEqual(decoded.size, (128, 64))
+
+    def test_combine_errors(self):
+        grid = Grid()
+        bad = SectionResult(grid[9], (255, 0, 0), 32)
+        bad.data = b"not an image"
+        requests = [SectionResult(grid[8], 255, 32, "L"), bad]
+        with self.assertLogs(level="ERROR"):
+            result = ImageProvider(grid).combine(
+                requests, 32, 32, ImageProvider.Output.ARRAY
+            )
+        self.assertEqual(result.image.shape, (32, 64, 3))
+        self.assertTrue((result.image[:, :32] > 250).all())
+        self.assertTrue((result.image[:, 32:] == 0).all())
+
+    def test_combine_reduced(self):
+        grid = Grid()
+        sections = list(grid.filter(h_min=-44, h_max=44, w_min=-170, w_max=-1))
+        requests = [SectionResult(s, (s.index * 10, 0, 200), 256) for s in sections]
+        requests[0] = SectionResult(sections[0], 128, 256, "L")
+
+        result = ImageProvider(grid).combine(
+            requests, 48, 48, ImageProvider.Output.ARRAY
+        )
+        self.assertEqual(result.image.shape, (96, 192, 3))
+        for req in requests[1:]:
+            x, y = result.to_pixel_coordinates((req.section.ax, req.section.ay))
+            pixel = result.image[int(y) - 24, int(x) + 24]
+            self.assertTrue(numpy.allclose(pixel, req.color, atol=3))
+        self.assertTrue(numpy.allclose(result.image[:48, :48], 128, atol=3))
+
+    def test_fetch_reduced(self):
+        grid = Grid()
+        request = SectionResult(grid[0], (10, 20, 30), 64)
+        result = ImageProvider(grid).fetch(request)
+        self.assertEqual(result.image.getvalue(), request.data)
+
+        result = ImageProvider(grid).fetch(request, size=Size(16, 24))
+        self.assertEqual((result.w, result.h), (16, 16))
+        with Image.open(result.image) as image:
+            self.assertEqual(image.size, (16, 16))
+
+        result = ImageProvider(grid).fetch(
+            request, size=Size(20, 20), output=ImageProvider.Output.ARRAY
+        )
+        self.assertEqual(result.image.shape, (20, 20, 3))
+        self.assertTrue(numpy.allclose(result.image, (10, 20, 30), atol=3))
+
+        with self.assertRaises(ValueError):
+            ImageProvider(grid).fetch(request, 64, 64, size=Size(16, 16))
+
 
 class TestClient(unittest.TestCase):
     def __init__(self, *args, **kwargs):
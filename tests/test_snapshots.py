@@ -0,0 +1,117 @@
+# Copyright(C) 2023 Horus View and Explore B.V.
+
+import unittest
+import io
+import os
+import tempfile
+
+from shapely.geometry import Point, LineString
+
+try:
+    from horus_media_examples import snapshots
+    from horus_spatialite import Spatialite, FrameMatchedIterator
+
+    spatialite_found = True
+except Exception:
+    spatialite_found = False
+
+
+class Database:
+    """A spatialite database with one geometry"""
+
+    geometry_field_name = "the_geom"
+
+    def __init__(self, geometry):
+        self.geometry = geometry
+        self.field_info_map = {"rowid": Spatialite.Field_info(0, "rowid", "INTEGER")}
+
+    def get_geometry(self, cursor):
+        return {self.geometry_field_name: self.geometry}
+
+
+class Frame:
+    index = 3
+    recordingid = 1
+
+    def get_location(self):
+        return (4.4800, 51.9100, 45.0)
+
+
+class Image:
+    def get_image(self):
+        return io.BytesIO(b"jpeg")
+
+
+class Camera:
+    """Records the geographic locations a snapshot looks at"""
+
+    def __init__(self):
+        self.geo_locations = []
+
+    def set_frame(self, recording, frame):
+        pass
+
+    def look_at_all(self, geo_locations, width):
+        self.geo_locations.append(geo_locations)
+        return None
+
+    def acquire(self, size, manual_fetch=False):
+        return Image()
+
+    def crop_to_geometry(self, image, geo_locations, draw_geometry=False):
+        return image
+
+
+@unittest.skipUnless(spatialite_found, "requires the SpatiaLite extension")
+class TestSnapshots(unittest.TestCase):
+    def matched_frame(self, recording=None):
+        mf = FrameMatchedIterator.MatchedFrame()
+        mf.spatialite_cursor = (7,)
+        mf.recording = recording
+        mf.frame = Frame() if recording else None
+        return mf
+
+    def test_look_at_geometry(self):
+        look_at_all = snapshots.look_at_geometry(
+            Point(4.4801, 51.9101, 44.0), self.matched_frame()
+        )
+        self.assertEqual(len(look_at_all), 1)
+        self.assertEqual(look_at_all[0].geometry.geom_type, "Polygon")
+
+        # 0.0003 degree latitude, 33 meter: split into pieces of at most 5 meters
+        linestring = LineString([(4.4801, 51.9101, 44.0), (4.4801, 51.9104, 44.0)])
+        look_at_all = snapshots.look_at_geometry(linestring, self.matched_frame())
+        self.assertEqual(len(look_at_all), 7)
+
+    def test_take_snapshot_without_frame(self):
+        db = Database(Point(4.4801, 51.9101, 44.0))
+        records = snapshots.take_snapshot(db, self.matched_frame())
+        self.assertEqual(len(records), 1)
+        self.assertTrue(records[0]["snapshot_error"].startswith("No frame found"))
+        self.assertIsNone(records[0]["frame_index"])
+
+    def test_take_snapshot(self):
+        db = Database(Point(4.4801, 51.9101, 44.0))
+        camera = Camera()
+        cwd = os.getcwd()
+        with tempfile.TemporaryDirectory() as directory:
+            os.chdir(directory)
+            os.mkdir("output")
+            sp_camera, snapshots.sp_camera = snapshots.sp_camera, camera
+            try:
+                records = snapshots.take_snapshot(db, self.matched_frame(object()))
+            finally:
+                snapshots.sp_camera = sp_camera
+                os.chdir(cwd)
+
+        self.assertEqual(len(records), 1)
+        self.assertEqual(records[0]["snapshot_error"], "")
+        self.assertEqual(records[0]["frame_index"], 3)
+        self.assertEqual(records[0]["snapshot"], "output/snapshot_db_id:7_1_Point.jpeg")
+        # the (closed) square of the point
+        self.assertEqual(len(camera.geo_locations), 1)
+        self.assertEqual(len(camera.geo_locations[0]), 5)
+
+
+if __name__ == "__main__":
+    unittest.main()
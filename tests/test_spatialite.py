@@ -0,0 +1,347 @@
+# Copyright(C) 2023 Horus View and Explore B.V.
+
+import unittest
+import os
+import re
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from collections import namedtuple
+from unittest import mock
+
+try:
+    from horus_spatialite import Spatialite
+    from horus_spatialite import FrameMatchedIterator, PipelinedFrameMatchedIterator
+
+    spatialite_found = True
+except Exception:
+    spatialite_found = False
+    # the frame matching runs on plain sqlite, the extension is not loaded
+    with mock.patch.dict(sys.modules, {"spatialite": mock.MagicMock()}):
+        from horus_spatialite import Spatialite
+        from horus_spatialite import FrameMatchedIterator, PipelinedFrameMatchedIterator
+
+
+Column = namedtuple("Column", ["name"])
+
+
+class RemoteCursor:
+    """Answers the frame, recording and image index queries of the remote database"""
+
+    def __init__(self):
+        self.rows = []
+        self.description = []
+
+    def execute(self, sql, params=()):
+        args = dict(zip(re.findall(r"(\w+) IN %s", sql), (p[0] for p in params)))
+        if "image_index_entries" in sql:
+            self.result(["file", "path"], ("file", "path"))
+        elif "MoviePlayer_recordingsetup" in sql:
+            self.result(
+                ["cameraHeight", "leverArmX", "leverArmY", "leverArmZ", "recording_id"],
+                (2.5, 0, 0, 0, params[0]),
+            )
+        elif "FROM recordings" in sql:
+            self.result(["id"], (args["id"],))
+        elif "FROM frames" in sql:
+            # later frames are resolved sooner
+            time.sleep(0.001 * (3 - args["index"] % 4))
+            self.result(
+                ["id", "recordingid", "index"],
+                (
+                    args["recordingid"] * 1000 + args["index"],
+                    args["recordingid"],
+                    args["index"],
+                ),
+            )
+
+    def result(self, names, row):
+        self.description = [Column(name) for name in names]
+        self.rows = [row]
+
+    def fetchone(self):
+        return self.rows.pop() if self.rows else None
+
+
+class RemoteConnection:
+    def cursor(self):
+        return RemoteCursor()
+
+
+class Pool:
+    """A connection pool that keeps track of the borrowed connections"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.borrowed = 0
+        self.used = 0
+
+    def getconn(self):
+        with self.lock:
+            self.borrowed += 1
+            self.used += 1
+        return RemoteConnection()
+
+    def putconn(self, connection):
+        with self.lock:
+            self.borrowed -= 1
+
+
+class Rows:
+    """A spatialite cursor that counts the rows read"""
+
+    def __init__(self, cursor):
+        self.cursor = cursor
+        self.fetched = 0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        row = next(self.cursor)
+        self.fetched += 1
+        return row
+
+    def fetchmany(self, size):
+        rows = self.cursor.fetchmany(size)
+        self.fetched += len(rows)
+        return rows
+
+
+@unittest.skipUnless(spatialite_found, "requires the SpatiaLite extension")
+class TestSpatialite(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.db = Spatialite(os.path.join(self.directory.name, "annotations.sqlite"))
+        self.db.open()
+        self.db.conn.execute(
+            "CREATE TABLE annotations (name TEXT, rec TEXT, the_geom GEOMETRY)"
+        )
+        for name, rec, x, y in [
+            ("a", "r2", 0, 0),
+            ("b", "r1", 5, 5),
+            ("c", "r1", 10, 10),
+            ("d", "r2", 5.5, 4.5),
+        ]:
+            self.db.conn.execute(
+                "INSERT INTO annotations VALUES (?, ?, GeomFromText(?, 4326))",
+                (name, rec, f"POINT({x} {y})"),
+            )
+        self.db.conn.commit()
+        self.db.resolve()
+
+    def tearDown(self):
+        self.db.close()
+        self.directory.cleanup()
+
+    def names(self, **kwargs):
+        cursor = self.db.query(**kwargs)
+        names = [row[0] for row in cursor.fetchall()]
+        cursor.close()
+        return names
+
+    def test_query(self):
+        self.assertEqual(
+            self.names(order_by_list=["rec", "name"]), ["b", "c", "a", "d"]
+        )
+        self.assertEqual(
+            self.names(order_by_list=["rec", "name"], where="name != 'b'", limit=2),
+            ["c", "a"],
+        )
+
+    def test_query_bbox(self):
+        self.assertFalse(self.db.has_spatial_index("the_geom"))
+        self.assertEqual(
+            self.names(order_by_list=["name"], bbox=(4, 4, 6, 6)), ["b", "d"]
+        )
+        self.assertEqual(
+            self.names(bbox=(4, 4, 6, 6), where="rec = 'r2'", limit=5), ["d"]
+        )
+
+    def test_query_bbox_spatial_index(self):
+        # the index boxes deliberately differ from the geometries
+        self.db.conn.execute(
+            "CREATE TABLE idx_annotations_the_geom "
+            "(pkid INTEGER, xmin REAL, xmax REAL, ymin REAL, ymax REAL)"
+        )
+        self.db.conn.executemany(
+            "INSERT INTO idx_annotations_the_geom VALUES (?, ?, ?, ?, ?)",
+            [(1, 0, 1, 0, 1), (2, 5, 7, 5, 7), (3, 2, 3, 8, 9), (4, 6.5, 8, 1, 2)],
+        )
+        self.db.conn.commit()
+        self.db.spatial_index_map.clear()
+        self.assertTrue(self.db.has_spatial_index("the_geom"))
+
+        def names(bbox):
+            return self.names(order_by_list=["name"], bbox=bbox)
+
+        # (xmin, ymin, xmax, ymax), found through the index boxes only
+        self.assertEqual(names((6, 6, 10, 10)), ["b"])
+        self.assertEqual(names((0, 6, 5, 6)), ["b"])
+        self.assertEqual(names((1.5, 6.5, 6, 8.5)), ["b", "c"])
+        self.assertEqual(names((6.9, 0, 7.5, 1.5)), ["d"])
+        self.assertEqual(names((20, 20, 30, 30)), [])
+
+
+class SchemaCursor:
+    """A sqlite cursor that counts the table info queries"""
+
+    def __init__(self, cursor, queries):
+        self.cursor = cursor
+        self.queries = queries
+
+    def execute(self, sql, params=()):
+        if sql.startswith("PRAGMA table_info"):
+            self.queries.append(sql)
+        return self.cursor.execute(sql, params)
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+
+class SchemaConnection:
+    def __init__(self):
+        self.connection = sqlite3.connect(":memory:")
+        self.connection.execute("CREATE TABLE annotations (name TEXT, rec TEXT)")
+        self.connection.execute("CREATE TABLE points (name TEXT)")
+        self.queries = []
+
+    def cursor(self):
+        return SchemaCursor(self.connection.cursor(), self.queries)
+
+    def close(self):
+        self.connection.close()
+
+
+class TestFieldInfoCache(unittest.TestCase):
+    def database(self):
+        db = Spatialite("annotations.sqlite")
+        db.conn = SchemaConnection()
+        db.resolve()
+        return db
+
+    def test_field_info_cached(self):
+        db = self.database()
+        self.assertEqual(len(db.conn.queries), 1)
+        self.assertEqual(list(db.field_info_map), ["name", "rec", "rowid"])
+
+        # queries reuse the field info of the table
+        db.query(where="rec = 'r1'").close()
+        db.query(order_by_list=["name"], limit=1).close()
+        self.assertIs(db.get_field_names_map(), db.field_info_map)
+        self.assertEqual(len(db.conn.queries), 1)
+
+        db.set_table_name("points")
+        self.assertEqual(list(db.get_field_names_map()), ["name", "rowid"])
+        db.set_table_name("annotations")
+        self.assertIs(db.get_field_names_map(), db.field_info_map)
+        self.assertEqual(len(db.conn.queries), 2)
+        db.close()
+
+    def test_field_info_per_instance(self):
+        db1 = self.database()
+        db2 = self.database()
+        self.assertEqual(len(db1.conn.queries), 1)
+        self.assertEqual(len(db2.conn.queries), 1)
+        self.assertEqual(db1.field_info_map, db2.field_info_map)
+        self.assertIsNot(db1.field_info_maps, db2.field_info_maps)
+
+        db2.set_table_name("points")
+        db2.get_field_names_map()
+        self.assertEqual(list(db1.field_info_maps), ["annotations"])
+        self.assertEqual(list(db2.field_info_maps), ["annotations", "points"])
+        self.assertEqual(len(db1.conn.queries), 1)
+        db1.close()
+        db2.close()
+
+
+class TestFrameMatchedIterator(unittest.TestCase):
+    def setUp(self):
+        self.db = Spatialite("annotations.sqlite")
+        self.db.conn = sqlite3.connect(":memory:")
+        self.db.conn.execute(
+            "CREATE TABLE annotations (name TEXT, frame_index INTEGER)"
+        )
+        self.db.conn.executemany(
+            "INSERT INTO annotations VALUES (?, ?)",
+            [(f"a{index}", index) for index in range(20)],
+        )
+        self.db.set_frame_index_field("frame_index")
+        self.db.resolve()
+
+    def tearDown(self):
+        self.db.close()
+
+    def rows(self):
+        return Rows(
+            self.db.conn.execute(
+                "SELECT name, frame_index, rowid FROM annotations ORDER BY rowid"
+            )
+        )
+
+    def matched(self, iterator):
+        iterator.set_static_recording_by_id(5)
+        return [
+            (f.spatialite_cursor, f.frame.id, f.recording.id, f.metadata)
+            for f in iterator
+        ]
+
+    def test_pipelined_order(self):
+        expected = self.matched(
+            FrameMatchedIterator(self.rows(), RemoteConnection(), self.db)
+        )
+        self.assertEqual(len(expected), 20)
+        self.assertEqual(expected[3][:3], (("a3", 3, 4), 5003, 5))
+
+        pool = Pool()
+        for chunk_size in [1, 3, 64]:
+            iterator = PipelinedFrameMatchedIterator(
+                self.rows(), RemoteConnection(), self.db, pool, chunk_size=chunk_size
+            )
+            self.assertEqual(self.matched(iterator), expected)
+        self.assertEqual(pool.used, 60)
+        self.assertEqual(pool.borrowed, 0)
+
+    def test_pipelined_prefetch(self):
+        rows = self.rows()
+        iterator = PipelinedFrameMatchedIterator(
+            rows, RemoteConnection(), self.db, Pool(), chunk_size=2, prefetch=3
+        )
+        iterator.set_static_recording_by_id(5)
+
+        for consumed, f in enumerate(iterator, 1):
+            self.assertEqual(f.frame.index, consumed - 1)
+            self.assertLessEqual(rows.fetched - consumed, 3 * 2)
+            if consumed == 1:
+                self.assertEqual(rows.fetched, 3 * 2)
+        self.assertEqual(consumed, 20)
+
+    def test_pipelined_close(self):
+        rows = self.rows()
+        pool = Pool()
+        with PipelinedFrameMatchedIterator(
+            rows, RemoteConnection(), self.db, pool, chunk_size=2
+        ) as iterator:
+            iterator.set_static_recording_by_id(5)
+            self.assertEqual(next(iterator).frame.index, 0)
+
+        # the workers are stopped, no rows are read after closing
+        self.assertRaises(RuntimeError, iterator.executor.submit, print)
+        self.assertEqual(pool.borrowed, 0)
+        self.assertRaises(StopIteration, next, iterator)
+        self.assertEqual(rows.fetched, 4 * 2)
+
+        iterator = PipelinedFrameMatchedIterator(
+            self.rows(), RemoteConnection(), self.db, pool
+        )
+        iterator.set_static_recording_by_id(5)
+        next(iterator)
+        iterator.close()
+        self.assertRaises(RuntimeError, iterator.executor.submit, print)
+        self.assertEqual(len(iterator.pending), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()